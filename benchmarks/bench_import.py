@@ -0,0 +1,81 @@
+"""Import time of the qlab packages.
+
+Every import is timed in fresh interpreters, after NumPy is imported, so
+that only the cost of qlab itself is measured. Each import must also leave
+the heavy or platform specific modules it does not need unloaded:
+
+    python benchmarks/bench_import.py
+    python benchmarks/bench_import.py --budget 0.02
+
+The exit status is 1 when an import loads a forbidden module or takes longer
+than the budget.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+# Statement, modules it must not load
+CASES = [
+    ('from qlab.utils import permanent', ['matplotlib', 'scipy', 'sqlite3', 'concurrent.futures']),
+    ('import qlab.utils', ['matplotlib', 'scipy', 'sqlite3', 'concurrent.futures',
+                           'qlab.utils.permanent']),
+    ('from qlab.utils import analyze_hom', ['matplotlib', 'scipy']),
+    ('import qlab.controllers', ['visa', 'pyvisa', 'qlab.controllers.IDQ800']),
+    ('from qlab.controllers import IDQ800', ['visa', 'pyvisa']),
+]
+
+CHILD = """
+import json, sys, time
+import numpy
+before = set(sys.modules)
+start = time.perf_counter()
+exec(%r)
+seconds = time.perf_counter() - start
+print(json.dumps({'seconds': seconds, 'modules': sorted(set(sys.modules) - before)}))
+"""
+
+def time_import(statement, repeat):
+    """Best time of ``statement`` over ``repeat`` fresh interpreters, and
+    the modules it loaded."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [ROOT] + ([os.environ['PYTHONPATH']] if 'PYTHONPATH' in os.environ else [])))
+    best, modules = float('inf'), []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', CHILD % statement], env=env,
+                                stdout=subprocess.PIPE, check=True).stdout
+        result = json.loads(output.decode().strip().split('\n')[-1])
+        best = min(best, result['seconds'])
+        modules = result['modules']
+    return best, modules
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=0.05,
+                        help='seconds allowed for one import (default: 0.05)')
+    parser.add_argument('--verbose', action='store_true',
+                        help='list the modules loaded by each import')
+    args = parser.parse_args(argv)
+
+    failures = []
+    for statement, forbidden in CASES:
+        seconds, modules = time_import(statement, args.repeat)
+        loaded = [m for m in forbidden if m in modules]
+        print('%-40s %9.2f ms  %4d modules' % (statement, seconds * 1e3, len(modules)))
+        if args.verbose:
+            print('    ' + ' '.join(modules))
+        if loaded:
+            failures.append('%s loads %s' % (statement, ', '.join(loaded)))
+        if seconds > args.budget:
+            failures.append('%s takes %.1f ms' % (statement, seconds * 1e3))
+    for failure in failures:
+        print('REGRESSION ' + failure)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,278 @@
+"""Benchmark of ``qlab.utils.permanent`` across sizes, dtypes and structures.
+
+Every case is timed and checked against a slow NumPy implementation of
+Ryser's formula, and bunched inputs against the permanent of the matrix
+with their rows and columns repeated. The other entry points are checked
+the same way: multiplicities on the expanded matrix, ``permanents`` and
+``permanent_minors`` on the sliced matrices, and matrices in non native
+byte order on their native copy. Results are saved as JSON, one file per
+machine, and compared with a stored baseline to flag speed or accuracy
+regressions:
+
+    python benchmarks/bench_permanent.py --save
+    python benchmarks/bench_permanent.py --update-baseline
+    python benchmarks/bench_permanent.py --baseline benchmarks/baselines/mybox.json
+
+The exit status is 1 when a regression is found.
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import sys
+import sysconfig
+import time
+
+import numpy as np
+
+from qlab.utils import permanent, permanents, permanent_minors
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DTYPES = ['complex128', 'complex64', 'float64', 'float32']
+STRUCTURES = ['unitary', 'real', 'lowrank']
+FUNCTIONS = ['multiplicities', 'permanents', 'minors', 'swapped']
+# Submatrices evaluated by each call of permanents
+BATCH = 32
+# The reference is exponential in memory too: only check up to this size
+REFERENCE_MAX_N = 16
+# Bunched inputs are checked against the expanded matrix up to this size
+EXPANDED_MAX_N = 24
+
+def reference_permanent(M):
+    """Ryser's formula with all the 2^n subsets at once, in NumPy."""
+    M = np.asarray(M, dtype=complex)
+    n = M.shape[0]
+    if n == 0:
+        return 1.0
+    subsets = (np.arange(1, 2 ** n)[:, None] >> np.arange(n)) & 1
+    signs = (-1.0) ** (n - subsets.sum(axis=1))
+    return np.sum(signs * np.prod(subsets @ M.T, axis=1))
+
+def random_matrix(structure, n, dtype, rng):
+    """An n x n test matrix with the given structure and dtype."""
+    if structure == 'unitary':
+        # Submatrix of a Haar random unitary, as in boson sampling
+        m = 2 * n
+        z = (rng.normal(size=(m, m)) + 1j * rng.normal(size=(m, m))) / np.sqrt(2)
+        q, r = np.linalg.qr(z)
+        M = (q * (np.diag(r) / np.abs(np.diag(r))))[:n, :n]
+    elif structure == 'real':
+        M = rng.normal(size=(n, n)) / np.sqrt(n)
+    elif structure == 'lowrank':
+        rank = min(3, n)
+        M = (rng.normal(size=(n, rank)) + 1j * rng.normal(size=(n, rank))) \
+            @ rng.normal(size=(rank, n)) / n
+    else:
+        raise ValueError('Unknown structure %s' % structure)
+    if np.dtype(dtype).kind == 'f':
+        M = M.real
+    return M.astype(dtype)
+
+def time_call(function, repeat, budget):
+    """Best time of up to ``repeat`` calls, stopping after ``budget`` seconds."""
+    best = np.inf
+    start = time.perf_counter()
+    for _ in range(repeat):
+        t = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - t)
+        if time.perf_counter() - start > budget:
+            break
+    return best, result
+
+def machine_info():
+    return {
+        'hostname': socket.gethostname(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'system': platform.system(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'compiler': platform.python_compiler(),
+        'cflags': sysconfig.get_config_var('CFLAGS'),
+        'cpu_count': os.cpu_count(),
+        # Rebuilding the extension (e.g. -march=native on another CPU)
+        # changes speed and numerics: record which build was measured
+        'extension': os.path.basename(sys.modules['qlab.utils.permanent'].__file__),
+        'extension_mtime': os.path.getmtime(sys.modules['qlab.utils.permanent'].__file__),
+    }
+
+def relative_error(value, reference):
+    return float(abs(value - reference) / max(abs(reference), 1e-300))
+
+def record(results, structure, dtype, n, threads, seconds, error):
+    results.append({'structure': structure, 'dtype': dtype, 'n': n,
+                    'threads': threads, 'seconds': seconds, 'rel_error': error})
+    print('%-14s %-10s n=%-3d %12.6f s  rel. error %s'
+          % (structure, dtype, n, seconds, '-' if error is None else '%.2e' % error))
+
+def run_multiplicities(multiplicities, threads, repeat, budget, rng):
+    """Bunched inputs: the two modes of a 2 x 2 unitary with ``c`` photons
+    each, for every ``c`` of ``multiplicities``, where the terms of the sum
+    over the multiplicities cancel the most."""
+    results = []
+    for c in multiplicities:
+        U = random_matrix('unitary', 2, 'complex128', rng)
+        mult = [c, c]
+        seconds, value = time_call(
+            lambda: permanent(U, row_mult=mult, col_mult=mult, threads=threads), repeat, budget)
+        error = None
+        if 2 * c <= EXPANDED_MAX_N:
+            expanded = np.repeat(np.repeat(U, mult, axis=0), mult, axis=1)
+            error = relative_error(value, permanent(expanded, threads=threads))
+        record(results, 'bunched', 'complex128', 2 * c, threads, seconds, error)
+    return results
+
+def function_case(function, n, dtype, threads, rng):
+    """The call of ``function`` on an n x n case, and its reference values."""
+    if function == 'multiplicities':
+        # n photons in about n/2 modes, some of them empty
+        k = max(n // 2, 1)
+        M = random_matrix('unitary', k, dtype, rng)
+        row_mult = rng.multinomial(n, np.ones(k) / k)
+        col_mult = rng.multinomial(n, np.ones(k) / k)
+        call = lambda: permanent(M, row_mult=row_mult, col_mult=col_mult, threads=threads)
+        reference = lambda: reference_permanent(
+            np.repeat(np.repeat(M, row_mult, axis=0), col_mult, axis=1))
+    elif function == 'permanents':
+        U = random_matrix('unitary', 2 * n, dtype, rng)
+        rows = np.sort(np.argsort(rng.random((BATCH, 2 * n)), axis=1)[:, :n], axis=1)
+        cols = np.sort(np.argsort(rng.random((BATCH, 2 * n)), axis=1)[:, :n], axis=1)
+        call = lambda: permanents(U, rows, cols, threads=threads)
+        reference = lambda: np.array([reference_permanent(U[r][:, c]) for r, c in zip(rows, cols)])
+    elif function == 'minors':
+        M = random_matrix('unitary', n, dtype, rng)
+        call = lambda: permanent_minors(M, threads=threads)
+        reference = lambda: np.array(
+            [[reference_permanent(np.delete(np.delete(M, i, axis=0), j, axis=1))
+              for j in range(n)] for i in range(n)])
+    elif function == 'swapped':
+        M = random_matrix('unitary', n, dtype, rng)
+        swapped = M.astype(M.dtype.newbyteorder())
+        call = lambda: permanent(swapped, threads=threads)
+        reference = lambda: reference_permanent(M)
+    else:
+        raise ValueError('Unknown function %s' % function)
+    return call, reference
+
+def run_functions(sizes, dtypes, functions, threads, repeat, budget, rng):
+    """The entry points other than ``permanent`` of a plain matrix, with the
+    largest relative error of their results."""
+    results = []
+    for function in functions:
+        for dtype in dtypes:
+            for n in sizes:
+                # The minors are n - 1 x n - 1
+                if n > REFERENCE_MAX_N + (function == 'minors'):
+                    continue
+                call, reference = function_case(function, n, dtype, threads, rng)
+                seconds, value = time_call(call, repeat, budget)
+                reference = np.asarray(reference())
+                error = float(np.max(np.abs(value - reference)
+                                     / np.maximum(np.abs(reference), 1e-300)))
+                record(results, function, dtype, n, threads, seconds, error)
+    return results
+
+def run(sizes, dtypes, structures, threads, repeat, budget, seed):
+    rng = np.random.default_rng(seed)
+    results = []
+    for structure in structures:
+        for dtype in dtypes:
+            for n in sizes:
+                M = random_matrix(structure, n, dtype, rng)
+                # Low rank matrices go through the rank dispatch, the others
+                # measure the Glynn kernels
+                lowrank = structure == 'lowrank'
+                seconds, value = time_call(
+                    lambda: permanent(M, threads=threads, lowrank=lowrank), repeat, budget)
+                error = None
+                if n <= REFERENCE_MAX_N:
+                    error = relative_error(value, reference_permanent(
+                        M.astype(np.result_type(M.dtype, np.float64))))
+                record(results, structure, dtype, n, threads, seconds, error)
+    return results
+
+def compare(results, baseline, time_tol, error_tol):
+    """Regressions of ``results`` with respect to ``baseline``."""
+    key = lambda r: (r['structure'], r['dtype'], r['n'], r['threads'])
+    old = {key(r): r for r in baseline['results']}
+    regressions = []
+    for r in results:
+        b = old.get(key(r))
+        if b is None:
+            continue
+        # Very short timings are too noisy to compare
+        if r['seconds'] > 1e-3 and r['seconds'] > b['seconds'] * (1 + time_tol):
+            regressions.append('%s %s n=%d: %.4g s, was %.4g s'
+                               % (r['structure'], r['dtype'], r['n'], r['seconds'], b['seconds']))
+        # A nan error, such as a wrongly read input, is always a regression
+        if r['rel_error'] is not None and b['rel_error'] is not None \
+                and not r['rel_error'] <= max(b['rel_error'] * error_tol, 1e-12):
+            regressions.append('%s %s n=%d: relative error %.2e, was %.2e'
+                               % (r['structure'], r['dtype'], r['n'], r['rel_error'], b['rel_error']))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[4, 8, 12, 16, 20, 24])
+    parser.add_argument('--dtypes', nargs='+', default=DTYPES, choices=DTYPES)
+    parser.add_argument('--structures', nargs='+', default=STRUCTURES, choices=STRUCTURES)
+    parser.add_argument('--functions', nargs='+', default=FUNCTIONS, choices=FUNCTIONS,
+                        help='other entry points to check, up to n=%d' % REFERENCE_MAX_N)
+    parser.add_argument('--multiplicities', type=int, nargs='+', default=[4, 8, 12],
+                        help='photons per mode of the bunched cases')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=2.0,
+                        help='seconds spent at most on repeats of one case')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--save', action='store_true',
+                        help='save the results in benchmarks/results/<machine>.json')
+    parser.add_argument('--baseline', help='baseline JSON to compare with '
+                        '(default: benchmarks/baselines/<machine>.json if it exists)')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='store these results as the baseline of this machine')
+    parser.add_argument('--time-tol', type=float, default=0.25,
+                        help='allowed relative slowdown (default: 0.25)')
+    parser.add_argument('--error-tol', type=float, default=100.0,
+                        help='allowed growth factor of the relative error (default: 100)')
+    args = parser.parse_args(argv)
+
+    info = machine_info()
+    name = '%s-%s' % (info['hostname'], info['machine'])
+    results = run(args.sizes, args.dtypes, args.structures, args.threads,
+                  args.repeat, args.budget, args.seed)
+    results += run_functions(args.sizes, args.dtypes, args.functions, args.threads,
+                             args.repeat, args.budget, np.random.default_rng(args.seed))
+    results += run_multiplicities(args.multiplicities, args.threads, args.repeat, args.budget,
+                                  np.random.default_rng(args.seed))
+    report = {'machine': info, 'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}
+
+    paths = []
+    if args.save:
+        paths.append(os.path.join(HERE, 'results', name + '.json'))
+    if args.update_baseline:
+        paths.append(os.path.join(HERE, 'baselines', name + '.json'))
+    for path in paths:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=1)
+        print('Saved %s' % path)
+
+    baseline_path = args.baseline or os.path.join(HERE, 'baselines', name + '.json')
+    if args.update_baseline or not os.path.exists(baseline_path):
+        return 0
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    if baseline['machine'].get('extension_mtime') != info['extension_mtime']:
+        print('Note: the extension was rebuilt since the baseline was stored.')
+    regressions = compare(results, baseline, args.time_tol, args.error_tol)
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    if not regressions:
+        print('No regressions with respect to %s' % baseline_path)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+"""Throughput and peak memory of the timestamp analysis pipeline.
+
+A HOM scan is simulated with ``qlab.utils.synthetic_hom_scan``, then taken
+through every stage of the analysis, from the timestamp files to the fits
+of the dips. Each stage is timed, then run again under tracemalloc for its
+peak memory, so that pipeline changes can be compared:
+
+    python benchmarks/bench_pipeline.py
+    python benchmarks/bench_pipeline.py --steps 50 --duration 2 --pair-rate 1e5
+    python benchmarks/bench_pipeline.py --save results.json
+
+The stages are:
+
+    generate      write the timestamp files of the scan
+    delays        calibrate the channel delays on the first step
+    coincidences  count the coincidences of every step, write the scan file
+    load          parse the scan file
+    fit           analyze_hom, parsing and fitting every pair of channels
+
+Memory mapped files are not counted in the peak memory.
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from qlab.utils import (synthetic_hom_scan, calibrate_delays, coincidences_scan,
+                        load_coincidences, analyze_hom, load_timestamps)
+
+def stages(args, directory):
+    """The stages of the pipeline, as ``(name, function, unit)``: each
+    function returns the number of items it processed, in ``unit``."""
+    prefix = os.path.join(directory, 'step')
+    scan = os.path.join(directory, 'scan.txt')
+    channels = 2 * args.pairs
+    pairs = [(2 * i, 2 * i + 1) for i in range(args.pairs)]
+    state = {}
+
+    def generate():
+        state['files'] = synthetic_hom_scan(prefix, args.steps, args.duration, args.visibility,
+                                            pair_rate=args.pair_rate, pairs=pairs,
+                                            dark_rates=args.dark_rate, jitter=args.jitter,
+                                            delays=args.delay * np.arange(channels),
+                                            channels=channels, seed=args.seed)
+        state['events'] = sum(load_timestamps(f).size for f in state['files'])
+        return state['events']
+
+    def delays():
+        state['delays'] = calibrate_delays(load_timestamps(state['files'][0]), args.max_delay,
+                                           channels_number=channels)
+        return load_timestamps(state['files'][0]).size
+
+    def coincidences():
+        coincidences_scan(state['files'], scan, args.window, state['delays'], channels)
+        return state['events']
+
+    def load():
+        load_coincidences(scan, args.steps, channels, cache=False)
+        return args.steps * channels * (channels - 1) // 2
+
+    def fit():
+        # Without the cached counts, as the load stage: the timed and the
+        # traced runs both parse the file
+        analyze_hom(scan, args.steps, channels, cache=False)
+        return channels * (channels - 1) // 2
+
+    return [('generate', generate, 'events'), ('delays', delays, 'events'),
+            ('coincidences', coincidences, 'events'), ('load', load, 'records'),
+            ('fit', fit, 'pairs')]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=1.0,
+                        help='seconds of acquisition per step (default: 1)')
+    parser.add_argument('--pair-rate', type=float, default=1e5,
+                        help='photon pairs per second on each pair of channels')
+    parser.add_argument('--dark-rate', type=float, default=1e4,
+                        help='uncorrelated events per second on each channel')
+    parser.add_argument('--pairs', type=int, default=2,
+                        help='pairs of channels receiving photon pairs (default: 2)')
+    parser.add_argument('--delay', type=int, default=20,
+                        help='delay between consecutive channels, in bins (default: 20)')
+    parser.add_argument('--visibility', type=float, default=0.9)
+    parser.add_argument('--jitter', type=float, default=6.0, help='in bins')
+    parser.add_argument('--window', type=int, default=25, help='in bins')
+    parser.add_argument('--max-delay', type=int, default=200, help='in bins')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip the runs under tracemalloc')
+    parser.add_argument('--directory', help='where to write the files (default: a temporary one)')
+    parser.add_argument('--save', help='save the results as JSON')
+    args = parser.parse_args(argv)
+
+    with contextlib.ExitStack() as stack:
+        directory = args.directory or stack.enter_context(tempfile.TemporaryDirectory())
+        results = []
+        pipeline = stages(args, directory)
+        for name, function, unit in pipeline:
+            start = time.perf_counter()
+            items = function()
+            results.append({'stage': name, 'seconds': time.perf_counter() - start,
+                            'items': items, 'unit': unit})
+        if not args.no_memory:
+            for result, (name, function, unit) in zip(results, pipeline):
+                tracemalloc.start()
+                function()
+                result['peak_mb'] = tracemalloc.get_traced_memory()[1] / 1e6
+                tracemalloc.stop()
+
+    print('%-13s %9s %12s %16s %10s' % ('stage', 'seconds', 'items', 'throughput', 'peak MB'))
+    for result in results:
+        print('%-13s %9.3f %12d %9.3g %-6s %10s' % (
+            result['stage'], result['seconds'], result['items'],
+            result['items'] / result['seconds'], result['unit'] + '/s',
+            '%.1f' % result['peak_mb'] if 'peak_mb' in result else '-'))
+    if args.save:
+        with open(args.save, 'w') as results_file:
+            json.dump({'arguments': vars(args), 'results': results}, results_file, indent=1)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
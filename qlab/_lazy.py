@@ -0,0 +1,46 @@
+"""Lazy attributes of the qlab packages.
+
+The packages expose the functions and classes of their submodules, but only
+import a submodule when one of its attributes is first used, so that
+``from qlab.utils import permanent`` does not pay for plotting libraries and
+``import qlab.controllers`` does not need the drivers of every instrument.
+"""
+import importlib
+import sys
+import types
+
+class _LazyPackage(types.ModuleType):
+    def __setattr__(self, name, value):
+        # Importing a submodule binds it on its package. Many attributes are
+        # named after their submodule (``hom_plot``, ``IDQ800``...): keep
+        # them pointing at the function or class, as with eager imports
+        if isinstance(value, types.ModuleType) and name in self._lazy_attributes:
+            return
+        super().__setattr__(name, value)
+
+def lazy_package(package_name, attributes):
+    """Makes the package ``package_name`` import its submodules on demand.
+
+    Args:
+        package_name (str): The name of the package, ``__name__`` in its
+            ``__init__.py``.
+        attributes (dict): The submodule of each attribute of the package.
+    """
+    package = sys.modules[package_name]
+
+    def __getattr__(name):
+        if name not in attributes:
+            raise AttributeError("module %r has no attribute %r" % (package_name, name))
+        module = importlib.import_module('.' + attributes[name], package_name)
+        value = getattr(module, name)
+        package.__dict__[name] = value
+        return value
+
+    def __dir__():
+        return sorted(set(package.__dict__) | set(attributes))
+
+    package.__getattr__ = __getattr__
+    package.__dir__ = __dir__
+    package.__all__ = sorted(attributes)
+    package._lazy_attributes = attributes
+    package.__class__ = _LazyPackage
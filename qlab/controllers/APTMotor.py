@@ -19,7 +19,7 @@ Michael Leung
 mcleung@stanford.edu
 """
 
-from ctypes import c_long, c_buffer, c_float, pointer, WinDLL
+from ctypes import c_long, c_buffer, c_float, pointer
 
 import os
 #print(os.getcwd())
@@ -50,6 +50,8 @@ class APTMotor():
         dllname = os.path.join(os.path.dirname(__file__), 'APT.dll')
         if not os.path.exists(dllname):
             print("ERROR: DLL not found")
+        # Windows only: imported here so that the module loads anywhere
+        from ctypes import WinDLL
         self.aptdll = WinDLL.LoadLibrary(dllname)
         self.aptdll.EnableEventDlg(True)
         self.aptdll.APTInit()
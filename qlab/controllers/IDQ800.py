@@ -1,7 +1,147 @@
-from ctypes import c_long, create_string_buffer, POINTER, byref, c_int, c_uint, WinDLL
-from time import sleep
+from ctypes import c_long, create_string_buffer, POINTER, byref, c_int, c_uint, c_int8, c_int32, c_longlong
+from time import sleep, perf_counter
 from operator import itemgetter
 from os import path
+from collections import deque
+import threading
+import numpy as np
+
+from ..utils.timestamps import TIMESTAMP_DTYPE
+
+class TimestampStream:
+    """The timestamps of ID800s, polled while they are acquired.
+
+    A background thread reads the timestamp buffer of every box in turn with
+    `TDC_getLastTimestamps` and copies the events in a ring buffer allocated
+    once. Iterating over the stream yields the chunks of events of each poll
+    as they arrive, until the acquisition time is over or :meth:`stop` is
+    called. A chunk is a view of the ring buffer: it is valid until the next
+    one is requested, copy it to keep it.
+
+    Args:
+        dll_lib: The loaded `tdcbase.dll`.
+        boxes (list): The ``(box_id, serial)`` of the boxes, in the order of
+            their numbers.
+        acq_time (float, optional): The acquisition time, in seconds.
+            Default: until :meth:`stop` is called.
+        buffer_size (int, optional): The number of events of the ring buffer.
+        poll_interval (float, optional): The time between polls, in seconds.
+        tdc_buffer_size (int, optional): The number of events of the
+            timestamp buffer of the TDC, filled between polls.
+
+    Attributes:
+        dropped (int): The number of events lost because the ring buffer was
+            full, when chunks are not consumed fast enough.
+    """
+
+    def __init__(self, dll_lib, boxes, acq_time=None, buffer_size=1 << 22, poll_interval=0.01,
+                 tdc_buffer_size=1000000):
+        self._dll_lib = dll_lib
+        self._boxes = boxes
+        self._acq_time = acq_time
+        self._poll_interval = poll_interval
+        self._tdc_buffer_size = tdc_buffer_size
+        self._ring = np.empty(buffer_size, dtype=TIMESTAMP_DTYPE)
+        # Events are written at head, and the oldest used events are read
+        # first: the free part of the ring is always after head
+        self._head = 0
+        self._used = 0
+        self._held = 0
+        self._chunks = deque()
+        self._condition = threading.Condition()
+        self._stopped = threading.Event()
+        self._done = False
+        self._error = None
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._poll, daemon=True)
+        self._thread.start()
+
+    def _poll(self):
+        try:
+            timestamps = np.empty(self._tdc_buffer_size, dtype=np.int64)
+            channels = np.empty(self._tdc_buffer_size, dtype=np.int8)
+            timestamps_ptr = timestamps.ctypes.data_as(POINTER(c_longlong))
+            channels_ptr = channels.ctypes.data_as(POINTER(c_int8))
+            valid = c_int32(0)
+            # Start from empty buffers
+            for box in self._boxes:
+                self._dll_lib.TDC_connect(c_int(box[0]))
+                self._dll_lib.TDC_setTimestampBufferSize(c_int(self._tdc_buffer_size))
+                self._dll_lib.TDC_getLastTimestamps(c_int(1), timestamps_ptr, channels_ptr, byref(valid))
+            end = None if self._acq_time is None else perf_counter() + self._acq_time
+            while True:
+                last = self._stopped.is_set() or (end is not None and perf_counter() >= end)
+                for i, box in enumerate(self._boxes):
+                    self._dll_lib.TDC_connect(c_int(box[0]))
+                    self._dll_lib.TDC_getLastTimestamps(c_int(1), timestamps_ptr, channels_ptr, byref(valid))
+                    self._push(i, timestamps[:valid.value], channels[:valid.value])
+                if last:
+                    break
+                self._stopped.wait(self._poll_interval if end is None else
+                                   max(min(self._poll_interval, end - perf_counter()), 0))
+        except Exception as error:
+            self._error = error
+        finally:
+            with self._condition:
+                self._done = True
+                self._condition.notify_all()
+
+    def _push(self, box, timestamps, channels):
+        """Copies events in the ring buffer, and queues them for the consumer."""
+        size = len(self._ring)
+        with self._condition:
+            free = size - self._used
+        if len(timestamps) > free:
+            self.dropped += len(timestamps) - free
+            timestamps, channels = timestamps[:free], channels[:free]
+        chunks = []
+        head = self._head
+        while len(timestamps):
+            stop = min(head + len(timestamps), size)
+            self._ring['timestamp'][head:stop] = timestamps[:stop - head]
+            self._ring['channel'][head:stop] = channels[:stop - head]
+            chunks.append((box, head, stop))
+            timestamps, channels = timestamps[stop - head:], channels[stop - head:]
+            head = stop % size
+        with self._condition:
+            self._head = head
+            for chunk in chunks:
+                self._used += chunk[2] - chunk[1]
+                self._chunks.append(chunk)
+            self._condition.notify_all()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """The next chunk of events, as ``(box, events)``, where ``box`` is the
+        number of the box, from 0, and ``events`` an array of dtype
+        :data:`qlab.utils.timestamps.TIMESTAMP_DTYPE`."""
+        with self._condition:
+            # The previous chunk is no longer used
+            self._used -= self._held
+            self._held = 0
+            while not self._chunks and not self._done:
+                self._condition.wait()
+            if not self._chunks:
+                if self._error is not None:
+                    raise self._error
+                raise StopIteration
+            box, start, stop = self._chunks.popleft()
+            self._held = stop - start
+        return box, self._ring[start:stop]
+
+    def stop(self):
+        """Stops polling, after a last poll. The events already polled can
+        still be iterated over."""
+        self._stopped.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
 
 class IDQ800:
     """An interface to the ID Quantique ID800 TDC.
@@ -10,6 +150,8 @@ class IDQ800:
         n_boxes (int): The number of ID800 connected to the computer.
         dll_path (str, optional): The absolute path to `tdcbase.dll`.
             Default: search in the package directory.
+        dll (optional): An object with the functions of `tdcbase.dll`, used
+            instead of it, such as a :class:`qlab.controllers.SimulatedTDCBase`.
 
     Raises:
         AssertionError: If ``n_boxes`` ID800s are not available
@@ -31,20 +173,34 @@ class IDQ800:
         The ID800s are numbered according to their serial numbers,
         in increasing order. So `timestamps1.bin` is relative to the lowest S/N.
 
+        Read them back with :func:`qlab.utils.load_timestamps`
+
+        >>> events = load_timestamps('timestamps1.bin')
+
+        Or stream the timestamps while they are acquired, without files
+
+        >>> for box, events in my_idq.stream_acquisition(acq_time = 5.3):
+        ...     clicks[box] += np.bincount(events['channel'], minlength = 8)
+
     Note:
         Remeber to  close the connection to the ID800s with
 
         >>> del my_idq
     """
 
-    def __init__(self, n_boxes, dll_path = None):
+    def __init__(self, n_boxes, dll_path = None, dll = None):
         self._n_boxes = n_boxes
 
         if dll_path is not None:
             self._dll_path = dll_path
         else:
             self._dll_path = path.join(path.dirname(__file__), 'tdcbase.dll')
-        self._dll_lib = WinDLL(self._dll_path)
+        if dll is not None:
+            self._dll_lib = dll
+        else:
+            # Windows only: imported here so that the module loads anywhere
+            from ctypes import WinDLL
+            self._dll_lib = WinDLL(self._dll_path)
 
         # Discover
         discovered_boxes = c_long(0)
@@ -67,28 +223,132 @@ class IDQ800:
         # Order boxes by serial
         self._boxes = sorted(self._serials_dict.items(), key=itemgetter(1))
 
+        # Start and stop times of the last run_acquisition
+        self.last_acquisition = None
+
     def __del__(self):
         self._dll_lib.TDC_deInit()
 
-    def run_acquisition(self, acq_time = 1.0, file_prefix="timestamps", file_suffix=".bin"):
-        done = False
-        #IDQ dll randomly gives an access violation error on the second TDC_writeTimestamps(). We keep trying until it works.
-        while (not done):
-            try:
-                done = True
-                #Start all the boxes
-                for i, box in enumerate(self._boxes):
-                    self._dll_lib.TDC_connect(c_int(box[0]))
-                    self._dll_lib.TDC_writeTimestamps(str.encode(file_prefix + str(i+1) + file_suffix), c_int(1))
+    def _write_timestamps(self, arguments, retries, backoff):
+        """Calls `TDC_writeTimestamps` on every box, back to back.
 
-                #Wait time seconds
-                sleep(acq_time)
+        The DLL works on one box at a time, selected with `TDC_connect`, so
+        the calls are made in a tight loop, with their arguments prepared
+        beforehand. A box whose call fails is retried on its own after the
+        others, with a wait doubled at every retry.
 
-                #Stop all the boxes
-                for i, box in enumerate(self._boxes):
-                    self._dll_lib.TDC_connect(c_int(box[0]))
-                    self._dll_lib.TDC_writeTimestamps()
+        Args:
+            arguments (list): The arguments of the call of each box, None
+                to skip the box.
+            retries (int): The number of retries of a box.
+            backoff (float): The wait before the first retry, in seconds.
+
+        Returns:
+            tuple: ``(times, attempts, errors)``, the time of the call of
+            each box, None if it failed, the number of attempts and the
+            last error of each box.
+        """
+        box_ids = [c_int(box[0]) for box in self._boxes]
+        times = [None] * len(self._boxes)
+        attempts = [0] * len(self._boxes)
+        errors = [None] * len(self._boxes)
+        pending = [i for i, args in enumerate(arguments) if args is not None]
+        for retry in range(retries + 1):
+            if retry:
+                sleep(backoff * 2 ** (retry - 1))
+            failed = []
+            for i in pending:
+                attempts[i] += 1
+                try:
+                    self._dll_lib.TDC_connect(box_ids[i])
+                    before = perf_counter()
+                    self._dll_lib.TDC_writeTimestamps(*arguments[i])
+                    times[i] = (before + perf_counter()) / 2
+                except Exception as error:
+                    #IDQ dll randomly gives an access violation error on TDC_writeTimestamps(). Only this box is retried.
+                    errors[i] = error
+                    failed.append(i)
+            pending = failed
+            if not pending:
+                break
+        return times, attempts, errors
+
+    def run_acquisition(self, acq_time = 1.0, file_prefix="timestamps", file_suffix=".bin",
+                        retries = 5, backoff = 0.05):
+        """Acquires the timestamps of all the boxes in files.
+
+        The boxes are started one right after the other, and stopped the same
+        way after ``acq_time``. A box that fails to start or stop is retried
+        alone, a bounded number of times, while the others keep acquiring. The
+        start times are recorded: their skew offsets the files from one
+        another.
+
+        Args:
+            acq_time (float, optional): The acquisition time, in seconds.
+            file_prefix (str, optional): The files are named ``file_prefix``,
+                the number of the box from 1, and ``file_suffix``.
+            file_suffix (str, optional): The end of the file names.
+            retries (int, optional): The number of retries of a box.
+            backoff (float, optional): The wait before the first retry of a
+                box, doubled at every retry, in seconds.
+
+        Returns:
+            dict: The ``start`` and ``stop`` times of each box, in seconds of
+            :func:`time.perf_counter`, the ``skew`` between the first and the
+            last start, in seconds, and the number of ``attempts`` to start
+            each box. It is also kept in ``last_acquisition``.
+
+        Raises:
+            RuntimeError: If a box cannot be started or stopped. The boxes
+                already started are stopped first.
+        """
+        names = [(str.encode(file_prefix + str(i+1) + file_suffix), c_int(1)) for i in range(len(self._boxes))]
+        starts, attempts, errors = self._write_timestamps(names, retries, backoff)
+        failed = [i for i, start in enumerate(starts) if start is None]
+        if failed:
+            self._write_timestamps([() if start is not None else None for start in starts], retries, backoff)
+            raise RuntimeError('Box %s could not be started: %s' % (self._boxes[failed[0]][1], errors[failed[0]]))
+
+        #Wait time seconds
+        sleep(acq_time)
+
+        stops, _, errors = self._write_timestamps([()] * len(self._boxes), retries, backoff)
+        self.last_acquisition = {'start': starts, 'stop': stops, 'skew': max(starts) - min(starts),
+                                 'attempts': attempts}
+        failed = [i for i, stop in enumerate(stops) if stop is None]
+        if failed:
+            raise RuntimeError('Box %s could not be stopped: %s' % (self._boxes[failed[0]][1], errors[failed[0]]))
+        return self.last_acquisition
+
+    def stream_acquisition(self, acq_time = None, callback = None, buffer_size = 1 << 22,
+                           poll_interval = 0.01, tdc_buffer_size = 1000000):
+        """Streams the timestamps of all the boxes while they are acquired.
+
+        Events are polled from the boxes by a background thread, see
+        :class:`TimestampStream`, and available during the acquisition
+        instead of in files at its end. Do not call :meth:`run_acquisition`
+        while a stream is running.
+
+        Args:
+            acq_time (float, optional): The acquisition time, in seconds.
+                Default: until the stream is stopped.
+            callback (callable, optional): Called with the number of the box
+                and the events of each chunk, until the acquisition is over.
+            buffer_size (int, optional): The number of events of the ring
+                buffer.
+            poll_interval (float, optional): The time between polls, in seconds.
+            tdc_buffer_size (int, optional): The number of events buffered
+                by each box between polls.
 
-            except:
-                done = False
-                print("Got error from IDQ, retrying.")
+        Returns:
+            TimestampStream: The stream to iterate over, or None if a
+            ``callback`` is given: the call then returns when the acquisition
+            is over.
+        """
+        stream = TimestampStream(self._dll_lib, self._boxes, acq_time, buffer_size,
+                                 poll_interval, tdc_buffer_size)
+        if callback is None:
+            return stream
+        with stream:
+            for box, events in stream:
+                callback(box, events)
@@ -0,0 +1,135 @@
+import threading
+from time import perf_counter, sleep
+import numpy as np
+
+from ..utils.timestamps import TIMESTAMP_DTYPE
+
+def _target(argument):
+    """The ctypes object behind an argument passed by value or by reference."""
+    return getattr(argument, '_obj', argument)
+
+def _value(argument):
+    return getattr(_target(argument), 'value', argument)
+
+class SimulatedTDCBase:
+    """A stand-in for `tdcbase.dll` that generates Poisson events.
+
+    It has the functions of the DLL used by :class:`qlab.controllers.IDQ800`,
+    called with the same ctypes arguments, so that acquisitions can be run
+    without the hardware. Each box has its own clock, started when the
+    simulator is created, in units of ``timebase``, and its events are drawn
+    when the clock is read, in the timestamp buffer and in the file being
+    written, if any. Calls can be slowed down, and `TDC_writeTimestamps` made
+    to fail at random like the access violations of the real DLL, to test
+    the timing and the retries of acquisitions.
+
+    Args:
+        n_boxes (int, optional): The number of simulated ID800s.
+        rates (float or array, optional): The rate of each channel, in
+            events per second, for all boxes or per box and channel.
+        channels (int, optional): The number of channels of a box.
+        serials (list, optional): The serial of each box, 4 characters.
+            Default: "1000", "1001"...
+        timebase (float, optional): The unit of the timestamps, in seconds.
+        failure_rate (float, optional): The probability that a call to
+            `TDC_writeTimestamps` raises an :class:`OSError`, without effect.
+        call_latency (float, optional): The duration of every call, in seconds.
+        seed (int, optional): The seed of the random events and failures.
+
+    Examples:
+        Stream 2 simulated boxes with 1 kHz on every channel
+
+        >>> my_idq = IDQ800(n_boxes = 2, dll = SimulatedTDCBase(n_boxes = 2, rates = 1e3))
+        >>> for box, events in my_idq.stream_acquisition(acq_time = 1.0):
+        ...     print(box, len(events))
+
+        Acquisitions where a start or stop fails one time in five
+
+        >>> my_idq = IDQ800(n_boxes = 2, dll = SimulatedTDCBase(n_boxes = 2, failure_rate = 0.2))
+        >>> attempts = my_idq.run_acquisition(acq_time = 1.0)['attempts']
+    """
+
+    def __init__(self, n_boxes=1, rates=1e5, channels=8, serials=None, timebase=81e-12,
+                 failure_rate=0.0, call_latency=0.0, seed=None):
+        self.n_boxes = n_boxes
+        self.timebase = timebase
+        self.failure_rate = failure_rate
+        self.call_latency = call_latency
+        self._rates = np.broadcast_to(np.asarray(rates, dtype=float), (n_boxes, channels))
+        self._serials = serials if serials is not None else \
+            ['%04d' % (1000 + box) for box in range(n_boxes)]
+        self._random = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+        self._current = 0
+        self._buffer_size = 1000000
+        self._origin = perf_counter()
+        self._clock = [0.0] * n_boxes
+        self._buffers = [np.empty(0, dtype=TIMESTAMP_DTYPE) for _ in range(n_boxes)]
+        self._files = [None] * n_boxes
+
+    def _advance(self, box):
+        """Draws the events of ``box`` up to now."""
+        start, stop = self._clock[box], perf_counter() - self._origin
+        self._clock[box] = stop
+        counts = self._random.poisson(self._rates[box] * (stop - start))
+        events = np.empty(counts.sum(), dtype=TIMESTAMP_DTYPE)
+        events['timestamp'] = np.sort(self._random.uniform(start, stop, events.size) / self.timebase)
+        events['channel'] = self._random.permutation(np.repeat(np.arange(counts.size), counts))
+        # The TDC keeps the last events only
+        self._buffers[box] = np.concatenate((self._buffers[box], events))[-self._buffer_size:]
+        if self._files[box] is not None:
+            events.tofile(self._files[box])
+
+    def TDC_discover(self, count):
+        _target(count).value = self.n_boxes
+        return 0
+
+    def TDC_getDeviceInfo(self, box, device_type, revision, serial, channels):
+        serial[5:9] = self._serials[_value(box)].encode()
+        return 0
+
+    def TDC_connect(self, box):
+        sleep(self.call_latency)
+        with self._lock:
+            self._current = _value(box)
+        return 0
+
+    def TDC_setTimestampBufferSize(self, size):
+        with self._lock:
+            self._buffer_size = _value(size)
+        return 0
+
+    def TDC_getLastTimestamps(self, reset, timestamps, channels, valid):
+        sleep(self.call_latency)
+        with self._lock:
+            box = self._current
+            self._advance(box)
+            events = self._buffers[box]
+            np.ctypeslib.as_array(timestamps, (events.size,))[:] = events['timestamp']
+            np.ctypeslib.as_array(channels, (events.size,))[:] = events['channel']
+            _target(valid).value = events.size
+            if _value(reset):
+                self._buffers[box] = events[:0]
+        return 0
+
+    def TDC_writeTimestamps(self, file_name=None, file_format=None):
+        sleep(self.call_latency)
+        with self._lock:
+            if self._random.random() < self.failure_rate:
+                raise OSError('exception: access violation reading 0x0000000000000000')
+            box = self._current
+            self._advance(box)
+            if self._files[box] is not None:
+                self._files[box].close()
+                self._files[box] = None
+            if file_name:
+                self._files[box] = open(file_name, 'wb')
+        return 0
+
+    def TDC_deInit(self):
+        with self._lock:
+            for box in range(self.n_boxes):
+                if self._files[box] is not None:
+                    self._files[box].close()
+                    self._files[box] = None
+        return 0
@@ -1,4 +1,11 @@
-from .LeoniFiberSwitch import LeoniFiberSwitch
-from .KeithleyPowerSupply import KeithleyPowerSupply
-from .IDQ800 import IDQ800
-from .APTMotor import APTMotor	
+from .._lazy import lazy_package
+
+# Drivers are imported when first used: each needs its own libraries
+# (VISA, Windows DLLs...)
+lazy_package(__name__, {
+    'LeoniFiberSwitch': 'LeoniFiberSwitch',
+    'KeithleyPowerSupply': 'KeithleyPowerSupply',
+    'IDQ800': 'IDQ800',
+    'APTMotor': 'APTMotor',
+    'SimulatedTDCBase': 'SimulatedTDCBase',
+})
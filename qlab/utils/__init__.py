@@ -1,2 +1,33 @@
-from .permanent import permanent
-from .hom_plot import hom_plot
+from .._lazy import lazy_package
+
+# Submodules are imported when one of their attributes is first used
+lazy_package(__name__, {
+    'permanent': 'permanent_lowrank',
+    'permanent_lowrank': 'permanent_lowrank',
+    'permanents': 'permanent',
+    'permanent_minors': 'permanent',
+    'hom_plot': 'hom_plot',
+    'load_coincidences': 'hom_plot',
+    'fit_hom': 'hom_fit',
+    'analyze_hom': 'hom_analysis',
+    'analyze_hom_campaign': 'hom_analysis',
+    'HOMFollower': 'hom_follower',
+    'follow_hom': 'hom_follower',
+    'output_distribution': 'output_distribution',
+    'boson_samples': 'boson_samples',
+    'permanent_approx': 'permanent_approx',
+    'PermanentCache': 'permanent_cache',
+    'load_timestamps': 'timestamps',
+    'iter_timestamps': 'timestamps',
+    'coincidence_counts': 'coincidences',
+    'multifold_counts': 'coincidences',
+    'write_coincidences': 'coincidences',
+    'coincidences_scan': 'coincidences',
+    'merge_timestamps': 'merge_timestamps',
+    'delay_histograms': 'delay_histograms',
+    'fit_delays': 'delay_histograms',
+    'calibrate_delays': 'delay_histograms',
+    'synthetic_timestamps': 'synthetic_timestamps',
+    'synthetic_hom_scan': 'synthetic_timestamps',
+    'fit_clocks': 'merge_timestamps',
+})
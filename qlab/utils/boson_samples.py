@@ -0,0 +1,60 @@
+import numpy as np
+from .permanent import permanent_minors
+
+def boson_samples(U, input_modes, n_samples=None, seed=None):
+    """Exact samples from the output distribution of a boson sampler.
+
+    Photons enter the modes ``input_modes`` of the interferometer ``U``,
+    whose element ``U[i, j]`` is the amplitude from input mode ``j`` to output
+    mode ``i``. Samples are drawn one at a time with the algorithm of Clifford
+    & Clifford (2018): the output modes are chosen one photon at a time, and
+    photon ``k`` only needs the ``k`` permanent minors of the
+    ``(k-1) x k`` submatrix of the modes already chosen, which come from a
+    single call to :func:`permanent_minors`. The full output
+    distribution is never built, so samples can be streamed indefinitely.
+
+    Args:
+        U (array): The m x m unitary of the interferometer.
+        input_modes (sequence of int): The input mode of each photon. A mode
+            may appear more than once.
+        n_samples (int, optional): The number of samples to draw.
+            Default: draw forever.
+        seed (optional): Seed or ``numpy.random.Generator`` for the random
+            numbers.
+
+    Yields:
+        tuple: The sorted output modes of each sample. A mode appears more
+        than once in bunched outputs.
+
+    Examples:
+        Count the outputs of two photons on a balanced beam splitter
+
+        >>> from collections import Counter
+        >>> U = np.array([[1, 1], [1, -1]]) / np.sqrt(2)
+        >>> Counter(boson_samples(U, [0, 1], 1000, seed=1))
+        Counter({(0, 0): 504, (1, 1): 496})
+    """
+    U = np.asarray(U, dtype=complex)
+    if U.ndim != 2:
+        raise ValueError("U must be a matrix.")
+    A = U[:, np.asarray(input_modes, dtype=np.intp)]
+    m, n = A.shape
+    rng = np.random.default_rng(seed)
+
+    drawn = 0
+    while n_samples is None or drawn < n_samples:
+        # The photons are indistinguishable: pick them in a random order
+        B = A[:, rng.permutation(n)]
+        modes = np.empty(n, dtype=np.intp)
+        for k in range(1, n + 1):
+            # The last row is a placeholder: its minors are the permanents
+            # of the chosen rows without each one of the first k columns
+            square = np.ones((k, k), dtype=complex)
+            square[:k - 1] = B[modes[:k - 1], :k]
+            minors = permanent_minors(square)[k - 1]
+            weights = np.abs(B[:, :k] @ minors) ** 2
+            cumulative = np.cumsum(weights)
+            modes[k - 1] = min(np.searchsorted(cumulative, rng.random() * cumulative[-1], side='right'),
+                               m - 1)
+        drawn += 1
+        yield tuple(np.sort(modes).tolist())
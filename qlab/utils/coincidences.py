@@ -0,0 +1,231 @@
+import numpy as np
+
+# Events processed at once: the temporaries of a block stay in the cache
+_BLOCK = 1 << 18
+
+def _chunks(events):
+    """The blocks of ``events``, an array of events or an iterable of them."""
+    if isinstance(events, np.ndarray):
+        events = [events]
+    for chunk in events:
+        for first in range(0, len(chunk), _BLOCK):
+            yield chunk[first:first + _BLOCK]
+
+def _ordered_blocks(events, delays, channels_number):
+    """Yields the times and channels of ``events``, minus the delay of their
+    channel, in increasing order, block by block.
+
+    Events of the channels from ``channels_number`` on are left out. The
+    input is in increasing raw time. Delays can swap events, so the
+    events of a chunk that the next chunks could still precede are held back:
+    no later event comes before the last raw time of the chunk minus the
+    largest delay.
+    """
+    pending_t = np.empty(0, dtype=np.int64)
+    pending_ch = np.empty(0, dtype=np.intp)
+    shift = delays is not None and np.any(delays != delays[0])
+    for chunk in _chunks(events):
+        if len(chunk) == 0:
+            continue
+        t = np.asarray(chunk['timestamp'], dtype=np.int64)
+        ch = np.asarray(chunk['channel'], dtype=np.intp)
+        if ch.max() >= channels_number:
+            t, ch = t[ch < channels_number], ch[ch < channels_number]
+            if t.size == 0:
+                continue
+        if delays is None:
+            yield t, ch
+            continue
+        bound = t[-1] - delays.max()
+        t = t - delays[ch]
+        if shift:
+            t = np.concatenate((pending_t, t))
+            ch = np.concatenate((pending_ch, ch))
+            order = np.argsort(t, kind='stable')
+            t, ch = t[order], ch[order]
+            cut = np.searchsorted(t, bound, 'left')
+            pending_t, pending_ch = t[cut:], ch[cut:]
+            t, ch = t[:cut], ch[:cut]
+        yield t, ch
+    if pending_t.size:
+        yield pending_t, pending_ch
+
+def _delays(delays, channels_number):
+    """The delays of all the channels, zero for those that are not given."""
+    if delays is None:
+        return None
+    delays = np.asarray(delays, dtype=np.int64).ravel()
+    return np.concatenate((delays, np.zeros(max(channels_number - delays.size, 0), dtype=np.int64)))
+
+def _close_pairs(events, window, delays, channels_number):
+    """Yields the pairs of events at most ``window`` apart, as the channels
+    of their first and second events and their time differences.
+
+    The pairs of events ``k`` positions apart are all found with a few array
+    operations, for ``k`` increasing until no pair is close enough, so the
+    events are swept as many times as there are events within a window.
+    """
+    tail_t = np.empty(0, dtype=np.int64)
+    tail_ch = np.empty(0, dtype=np.intp)
+    for t, ch in _ordered_blocks(events, delays, channels_number):
+        if t.size == 0:
+            continue
+        # The last events of the previous blocks pair with the first ones of
+        # this block: pairs of two tail events were already counted
+        first = tail_t.size
+        t = np.concatenate((tail_t, t))
+        ch = np.concatenate((tail_ch, ch))
+        for k in range(1, t.size):
+            gaps = t[k:] - t[:-k]
+            close = gaps <= window
+            if not close.any():
+                break
+            close[:max(first - k, 0)] = False
+            i = np.flatnonzero(close)
+            yield ch[i], ch[i + k], gaps[i]
+        keep = np.searchsorted(t, t[-1] - window, 'left')
+        tail_t, tail_ch = t[keep:], ch[keep:]
+
+def coincidence_counts(events, window, delays=None, channels_number=16):
+    """Counts the two-fold coincidences of all the pairs of channels.
+
+    Two events of different channels are in coincidence when their times,
+    once the delay of each channel is taken off, are at most ``window``
+    apart. Every such pair of events counts once, so an event in coincidence
+    with events of two other channels counts for both pairs.
+
+    The events are swept a few times with vectorized operations, as many
+    as there are events within a window, so the cost is linear in the number
+    of events.
+
+    Args:
+        events: The events, sorted by time, in an array of dtype
+            :data:`qlab.utils.timestamps.TIMESTAMP_DTYPE` or an iterable of
+            such chunks, as returned by :func:`qlab.utils.iter_timestamps`.
+        window (int): The coincidence window, in units of the timestamps.
+        delays (array, optional): The delay of each channel, subtracted from
+            its timestamps. Default: no delays.
+        channels_number (int, optional): The number of channels: events of
+            the other channels are left out.
+
+    Returns:
+        array: The symmetric matrix of the coincidences between the channels
+        ``i`` and ``j``, numbered from 0, with a zero diagonal.
+
+    Examples:
+        Coincidences within 2 ns (25 bins of 81 ps) of the first box
+
+        >>> counts = coincidence_counts(iter_timestamps('timestamps1.bin'), 25, channels_number=8)
+    """
+    delays = _delays(delays, channels_number)
+    counts = np.zeros(channels_number * channels_number, dtype=np.int64)
+    for first, second, _ in _close_pairs(events, window, delays, channels_number):
+        counts += np.bincount(first * channels_number + second,
+                              minlength=channels_number * channels_number)
+    counts = counts.reshape(channels_number, channels_number)
+    counts = counts + counts.T
+    np.fill_diagonal(counts, 0)
+    return counts
+
+def multifold_counts(events, window, delays=None, channels_number=16):
+    """Counts the coincidences of every set of channels.
+
+    Events are grouped in clusters, chains of events at most ``window``
+    apart once the delays are taken off, and each cluster counts once for
+    the set of channels it contains, as a bitmask. Clusters are found and
+    reduced to their bitmasks with a few array operations per chunk.
+
+    Args:
+        events: The events, sorted by time, see :func:`coincidence_counts`.
+        window (int): The largest time between consecutive events of a
+            cluster.
+        delays (array, optional): The delay of each channel.
+        channels_number (int, optional): The number of channels, at most 64.
+
+    Returns:
+        dict: The number of clusters of each set of at least two channels,
+        keyed by the tuple of the channels, numbered from 0.
+
+    Examples:
+        Three-fold coincidences of the channels 0, 1 and 2
+
+        >>> multifold_counts(iter_timestamps('timestamps1.bin'), 25, channels_number=8)[(0, 1, 2)]
+    """
+    if channels_number > 64:
+        raise ValueError("At most 64 channels are supported.")
+    delays = _delays(delays, channels_number)
+    masks = {}
+    carry_t = np.empty(0, dtype=np.int64)
+    carry_ch = np.empty(0, dtype=np.intp)
+
+    def add(t, ch):
+        starts = np.flatnonzero(np.concatenate(([True], np.diff(t) > window)))
+        bits = np.left_shift(np.uint64(1), ch.astype(np.uint64))
+        cluster_masks = np.bitwise_or.reduceat(bits, starts)
+        # Clusters of a single channel are not coincidences
+        cluster_masks = cluster_masks[(cluster_masks & (cluster_masks - np.uint64(1))) != 0]
+        values, occurrences = np.unique(cluster_masks, return_counts=True)
+        for value, n in zip(values.tolist(), occurrences.tolist()):
+            masks[value] = masks.get(value, 0) + n
+
+    for t, ch in _ordered_blocks(events, delays, channels_number):
+        if t.size == 0:
+            continue
+        t = np.concatenate((carry_t, t))
+        ch = np.concatenate((carry_ch, ch))
+        # The last cluster may go on in the next block
+        last = np.flatnonzero(np.diff(t) > window)
+        last = last[-1] + 1 if last.size else 0
+        if last:
+            add(t[:last], ch[:last])
+        carry_t, carry_ch = t[last:], ch[last:]
+    if carry_t.size:
+        add(carry_t, carry_ch)
+    return {tuple(c for c in range(channels_number) if mask >> c & 1): n
+            for mask, n in sorted(masks.items())}
+
+def write_coincidences(file_name, step_counts):
+    """Writes two-fold coincidences in the format read by
+    :func:`qlab.utils.load_coincidences`.
+
+    Args:
+        file_name (str): The coincidence file.
+        step_counts: For each step, the matrix of the coincidences between
+            the channels, as returned by :func:`coincidence_counts`.
+    """
+    with open(file_name, 'w') as coinc_file:
+        for step, counts in enumerate(step_counts):
+            counts = np.asarray(counts)
+            c1, c2 = np.triu_indices(counts.shape[0], 1)
+            coinc_file.write("%d\n" % step)
+            coinc_file.write("".join("%02d_%02d %d\n" % record for record in
+                                     zip((c1 + 1).tolist(), (c2 + 1).tolist(),
+                                         counts[c1, c2].tolist())))
+
+def coincidences_scan(step_files, file_name, window, delays=None, channels_number=16,
+                      chunk_size=1 << 22):
+    """Counts the coincidences of every step of a scan and writes them for
+    :func:`qlab.utils.hom_plot`.
+
+    Args:
+        step_files (list): The timestamp file of each step.
+        file_name (str): The coincidence file to write.
+        window (int): The coincidence window, in units of the timestamps.
+        delays (array, optional): The delay of each channel.
+        channels_number (int, optional): The number of channels.
+        chunk_size (int, optional): The number of events read at once.
+
+    Returns:
+        array: The coincidences of each step, steps x channels x channels.
+
+    Examples:
+        >>> files = ['step%03d_timestamps1.bin' % step for step in range(100)]
+        >>> coincidences_scan(files, 'scan.txt', 25, channels_number=8)
+        >>> hom_plot(100, 8, 'scan.txt')
+    """
+    from .timestamps import iter_timestamps
+    step_counts = np.array([coincidence_counts(iter_timestamps(step_file, chunk_size), window,
+                                               delays, channels_number)
+                            for step_file in step_files])
+    write_coincidences(file_name, step_counts)
+    return step_counts
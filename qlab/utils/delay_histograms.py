@@ -0,0 +1,155 @@
+import numpy as np
+from .coincidences import _close_pairs, _delays
+
+# The centroid of a peak is taken within this many standard deviations of
+# the peak, refined at most this many times
+_CENTROID_WIDTHS = 4
+_CENTROID_ITERATIONS = 20
+
+def delay_histograms(events, max_delay, bin_width=1, delays=None, channels_number=16):
+    """Histograms the delays between the events of every pair of channels.
+
+    All the pairs of events at most ``max_delay`` apart are found in one
+    vectorized pass over the sorted events, see
+    :func:`qlab.utils.coincidence_counts`, instead of comparing every event
+    with every other one, and binned at once for all the pairs of channels.
+
+    Args:
+        events: The events, sorted by time, in an array of dtype
+            :data:`qlab.utils.timestamps.TIMESTAMP_DTYPE` or an iterable of
+            such chunks.
+        max_delay (int): The largest delay, in units of the timestamps.
+        bin_width (int, optional): The width of the bins.
+        delays (array, optional): The delay of each channel, subtracted from
+            its timestamps. Default: no delays.
+        channels_number (int, optional): The number of channels.
+
+    Returns:
+        tuple: ``(histograms, bins)``. ``histograms[i, j]`` counts the pairs
+        of events of the channels ``i`` and ``j``, numbered from 0, by the
+        time of the event of ``j`` minus the time of the event of ``i``,
+        falling in the bins starting at ``bins``.
+
+    Examples:
+        Cross-correlation of the channels 0 and 1 within 10 ns
+
+        >>> histograms, bins = delay_histograms(iter_timestamps('timestamps1.bin'), 123, channels_number=8)
+        >>> plt.plot(bins, histograms[0, 1])
+    """
+    delays = _delays(delays, channels_number)
+    low = -max_delay // bin_width
+    bins_number = max_delay // bin_width - low + 1
+    size = channels_number * channels_number * bins_number
+    histograms = np.zeros(size, dtype=np.int64)
+    for first, second, gaps in _close_pairs(events, max_delay, delays, channels_number):
+        # Each pair counts for both orders of its channels
+        histograms += np.bincount((first * channels_number + second) * bins_number
+                                  + gaps // bin_width - low, minlength=size)
+        histograms += np.bincount((second * channels_number + first) * bins_number
+                                  + -gaps // bin_width - low, minlength=size)
+    histograms = histograms.reshape(channels_number, channels_number, bins_number)
+    histograms[np.arange(channels_number), np.arange(channels_number)] = 0
+    return histograms, (np.arange(bins_number) + low) * bin_width
+
+def fit_delays(histograms, bins, reference_channel=0, significance=5):
+    """Fits the delay of every channel from the peaks of their delay
+    histograms.
+
+    The peak of every pair of channels that stands out of the background is
+    located to a fraction of a bin, by its centroid over the median within a
+    few standard deviations of the peak, iterated until it settles, and the
+    delays of the channels fitted by weighted least squares to the delays of
+    the peaks.
+
+    Args:
+        histograms (array): The delay histograms, as returned by
+            :func:`delay_histograms`.
+        bins (array): The start of the bins.
+        reference_channel (int, optional): The channel of delay zero.
+        significance (float, optional): The height of a peak over the
+            background, in standard deviations of the background, for the
+            pair to be used.
+
+    Returns:
+        array: The delay of each channel, in units of the timestamps, ready
+        for :func:`qlab.utils.coincidence_counts`. Channels without a path
+        of peaks to the reference one are timed from the lowest channel
+        they have such a path to.
+
+    Examples:
+        >>> delays = fit_delays(*delay_histograms(iter_timestamps('timestamps1.bin'), 123, channels_number=8))
+        >>> counts = coincidence_counts(iter_timestamps('timestamps1.bin'), 25, delays, channels_number=8)
+    """
+    channels_number = histograms.shape[0]
+    bin_width = bins[1] - bins[0] if len(bins) > 1 else 1
+    c1, c2 = np.triu_indices(channels_number, 1)
+    pairs = histograms[c1, c2].astype(float)
+    background = np.median(pairs, axis=1)
+    peak = np.argmax(pairs, axis=1)
+    height = pairs[np.arange(len(pairs)), peak] - background
+    used = height > significance * np.sqrt(background + 1)
+
+    # Centroid of the peak over the background, in a window of a few widths
+    # of the peak: the width is first taken from the bins over half the
+    # height, then both are refined from the second moment in the window
+    centers = bins + (bin_width - 1) / 2
+    weights = np.clip(pairs - background[:, None], 0, None)
+    position = centers[peak].astype(float)
+    width = np.maximum(np.count_nonzero(weights > height[:, None] / 2, axis=1), 1) \
+        * bin_width / 2.355
+    for _ in range(_CENTROID_ITERATIONS):
+        inside = np.abs(centers - position[:, None]) <= \
+            np.maximum(_CENTROID_WIDTHS * width, 2 * bin_width)[:, None]
+        w = weights * inside
+        total = np.maximum(w.sum(axis=1), 1)
+        new_position = (w * centers).sum(axis=1) / total
+        width = np.sqrt((w * (centers - new_position[:, None]) ** 2).sum(axis=1) / total)
+        converged = np.all(np.abs(new_position - position) < 0.01 * bin_width)
+        position = new_position
+        if converged:
+            break
+
+    # Channels linked by peaks form groups, each with a channel of delay
+    # zero: the reference one, or the lowest of the group
+    group = np.arange(channels_number)
+    for a, b in zip(c1[used].tolist(), c2[used].tolist()):
+        group[group == group[b]] = group[a]
+    anchors = {group[reference_channel]: reference_channel}
+    for c, g in enumerate(group.tolist()):
+        anchors.setdefault(g, c)
+    fitted = [c for c in range(channels_number) if anchors[group[c]] != c]
+    delays = np.zeros(channels_number)
+    if fitted:
+        # The delay of the peak of (i, j) is the delay of j minus the delay of i
+        design = np.zeros((np.count_nonzero(used), channels_number))
+        rows = np.arange(design.shape[0])
+        design[rows, c1[used]] = -1
+        design[rows, c2[used]] = 1
+        weight = np.sqrt(height[used])
+        delays[fitted] = np.linalg.lstsq(design[:, fitted] * weight[:, None],
+                                         position[used] * weight, rcond=None)[0]
+    return np.rint(delays).astype(np.int64)
+
+def calibrate_delays(events, max_delay, bin_width=1, channels_number=16, reference_channel=0):
+    """Measures the delays of the channels from their cross-correlations.
+
+    Args:
+        events: The events, sorted by time. A run long enough for the peaks
+            to stand out, read with :func:`qlab.utils.load_timestamps`, or
+            an iterable of chunks. Iterators can only be used once, so pass
+            an array to count the coincidences of the same events afterwards.
+        max_delay (int): The largest delay between two channels.
+        bin_width (int, optional): The width of the bins of the histograms.
+        channels_number (int, optional): The number of channels.
+        reference_channel (int, optional): The channel of delay zero.
+
+    Returns:
+        array: The delay of each channel, see :func:`fit_delays`.
+
+    Examples:
+        >>> events = load_timestamps('timestamps1.bin')
+        >>> delays = calibrate_delays(events, 123, channels_number=8)
+        >>> counts = coincidence_counts(events, 25, delays, channels_number=8)
+    """
+    histograms, bins = delay_histograms(events, max_delay, bin_width, channels_number=channels_number)
+    return fit_delays(histograms, bins, reference_channel)
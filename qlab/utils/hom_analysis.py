@@ -0,0 +1,146 @@
+import functools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from .hom_fit import fit_hom
+from .hom_plot import HOM_func, load_coincidences, _channel_tags, _starting_parameters
+
+HOM_RESULT_DTYPE = np.dtype([
+    ('tag', 'U5'), ('counts', np.int64), ('converged', bool),
+    ('a', float), ('a_err', float), ('vis', float), ('vis_err', float),
+    ('x0', float), ('x0_err', float), ('sigma', float), ('sigma_err', float),
+])
+
+def _results_table(tags, coinc_counts, fitted, params, covariances, converged):
+    """The table of :func:`analyze_hom` from the fits of the rows ``fitted``
+    of ``coinc_counts``."""
+    results = np.zeros(len(tags), dtype=HOM_RESULT_DTYPE)
+    results['tag'] = tags
+    results['counts'] = coinc_counts.sum(axis=1)
+    ok = fitted[converged]
+    results['converged'][ok] = True
+    for k, name in enumerate(('a', 'vis', 'x0', 'sigma')):
+        results[name] = results[name + '_err'] = np.nan
+        results[name][ok] = params[converged, k]
+        results[name + '_err'][ok] = np.sqrt(covariances[converged, k, k])
+    return results
+
+def _render_figure(path, tag, counts, params):
+    """Draws the counts of a pair and its fit, if any, in a PNG file.
+
+    Only the object-oriented matplotlib API is used, with the Agg canvas, so
+    that rendering needs no display and works in any process.
+    """
+    import matplotlib.style
+    from matplotlib.figure import Figure
+
+    points = np.arange(1, counts.size + 1)
+    with matplotlib.style.context('ggplot'):
+        fig = Figure(figsize=(8, 5))
+        ax = fig.subplots()
+        if params is not None:
+            ax.plot(points, HOM_func(points, *params), '--')
+            ax.plot((params[2], params[2]), (0, np.min(counts)/2), '--')
+        ax.errorbar(y=counts, x=points, yerr=np.sqrt(counts), fmt='o', color='indianred')
+        ax.set_ylim(bottom=0)
+        ax.set_title(tag)
+        ax.set_ylabel('Coincidences')
+        ax.set_xlabel('Displacement')
+        fig.savefig(path)
+    return path
+
+def analyze_hom(file_name, steps_number, channels_number, exclude_channels=[], center=-1,
+                figures=None, processes=None, cache=True):
+    """Fits the HOM dips of a scan without any user interaction.
+
+    This is :func:`hom_plot` for scripts and compute nodes: nothing is shown
+    and nothing is printed but the unknown tags of the file. Figures are
+    optional and written to files, and matplotlib is only imported when they
+    are requested.
+
+    Args:
+        file_name (str): The coincidence file, see :func:`load_coincidences`.
+        steps_number (int): The number of steps of the scan.
+        channels_number (int): The number of channels.
+        exclude_channels (list, optional): Channels whose pairs are skipped.
+        center (float, optional): The starting position of the dips.
+            Default: the middle of the scan.
+        figures (str, optional): A directory where to save one PNG figure per
+            pair with counts, named after the file and the pair.
+            Default: no figures.
+        processes (int, optional): The number of processes rendering the
+            figures. Default: the number of CPUs. With 1, figures are
+            rendered in this process.
+        cache (bool, optional): Whether to use and write the cached counts,
+            see :func:`load_coincidences`. Default: True.
+
+    Returns:
+        array: A structured array with one row per pair of channels, of dtype
+        :data:`HOM_RESULT_DTYPE`: the "NN_MM" tag, the total counts, whether
+        the fit converged and the fitted parameters with their errors. The
+        parameters of pairs without counts or whose fit did not converge are
+        NaN.
+
+    Examples:
+        >>> results = analyze_hom('scan.txt', 100, 16, figures='plots')
+        >>> results[results['converged']][['tag', 'vis', 'vis_err']]
+    """
+    if center == -1:
+        center = steps_number/2
+    coinc_counts = load_coincidences(file_name, steps_number, channels_number, exclude_channels,
+                                     cache=cache)
+    tags = _channel_tags(channels_number, exclude_channels)
+    coinc_counts = np.asarray(coinc_counts[:len(tags)])
+
+    fitted = np.flatnonzero(coinc_counts.sum(axis=1) != 0)
+    points = np.arange(1, steps_number + 1)
+    params, covariances, converged = fit_hom(points, coinc_counts[fitted],
+                                             _starting_parameters(coinc_counts[fitted], center))
+    results = _results_table(tags, coinc_counts, fitted, params, covariances, converged)
+
+    if figures is not None:
+        os.makedirs(figures, exist_ok=True)
+        base = os.path.splitext(os.path.basename(file_name))[0]
+        jobs = [(os.path.join(figures, '%s_%s.png' % (base, tags[i])), tags[i], coinc_counts[i],
+                 params[k] if converged[k] else None) for k, i in enumerate(fitted)]
+        if processes == 1:
+            for job in jobs:
+                _render_figure(*job)
+        else:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                list(executor.map(_render_figure, *zip(*jobs)))
+    return results
+
+def analyze_hom_campaign(file_names, steps_number, channels_number, exclude_channels=[],
+                         center=-1, figures=None, processes=None):
+    """Runs :func:`analyze_hom` on many scans, one process per scan.
+
+    Args:
+        file_names (list): The coincidence files.
+        steps_number (int): The number of steps of the scans.
+        channels_number (int): The number of channels.
+        exclude_channels (list, optional): Channels whose pairs are skipped.
+        center (float, optional): The starting position of the dips.
+        figures (str, optional): A directory where to save the figures.
+        processes (int, optional): The number of processes.
+            Default: the number of CPUs.
+
+    Returns:
+        list: The results of every file, in the order of ``file_names``.
+
+    Examples:
+        >>> import glob
+        >>> files = sorted(glob.glob('campaign/*.txt'))
+        >>> results = analyze_hom_campaign(files, 100, 16)
+        >>> visibilities = np.array([r['vis'] for r in results])
+    """
+    # Each scan renders its own figures: the processes are already busy
+    analyze = functools.partial(analyze_hom, steps_number=steps_number,
+                                channels_number=channels_number,
+                                exclude_channels=exclude_channels, center=center,
+                                figures=figures, processes=1)
+    if processes == 1:
+        return [analyze(file_name) for file_name in file_names]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(analyze, file_names))
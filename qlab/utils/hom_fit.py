@@ -0,0 +1,141 @@
+import numpy as np
+
+_K = 4 * np.log(2)
+
+def _hom_model(x, p):
+    """The HOM dip ``a * (1 - vis * exp(-4 ln2 ((x - x0) / sigma)**2))`` of
+    every pair and its Jacobian with respect to ``(a, vis, x0, sigma)``.
+
+    Args:
+        x (array): The positions, pairs x points.
+        p (array): The parameters, pairs x 4.
+
+    Returns:
+        tuple: The model, pairs x points, and the Jacobian, pairs x points x 4.
+    """
+    a, vis, x0, sigma = (p[:, k, None] for k in range(4))
+    u = (x - x0) / sigma
+    g = np.exp(-_K * u ** 2)
+    avg = a * vis * g
+    jacobian = np.stack((1 - vis * g,
+                         -a * g,
+                         -2 * _K * avg * u / sigma,
+                         -2 * _K * avg * u ** 2 / sigma), axis=-1)
+    return a * (1 - vis * g), jacobian
+
+def _solve(A, b):
+    """Solves the stacked systems ``A x = b``, with least squares for the
+    singular ones."""
+    try:
+        return np.linalg.solve(A, b[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        return np.einsum('pij,pj->pi', np.linalg.pinv(A), b)
+
+def fit_hom(x, counts, p0=None, sigma=None, max_iter=200, ftol=1.5e-8, gtol=1e-10):
+    """Fits HOM dips to the coincidence counts of all channel pairs at once.
+
+    Every pair is fitted with Levenberg-Marquardt iterations using the
+    analytic Jacobian of the dip, and the iterations of all the pairs are
+    stacked in NumPy arrays: one iteration costs a few operations on
+    pairs x points arrays and a batch of 4 x 4 solves, whatever the number
+    of pairs. Pairs drop out of the iterations as they converge.
+
+    Args:
+        x (array): The positions of the points, shared by all pairs or one
+            row per pair.
+        counts (array): The counts, pairs x points, or a single row.
+        p0 (array, optional): The starting ``(a, vis, x0, sigma)``, shared by
+            all pairs or one row per pair. Default: the largest count, 0.5,
+            the position of the smallest count and a tenth of the scan range.
+        sigma (array, optional): The uncertainties on the counts.
+            Default: the square root of the counts. Uncertainties are clipped
+            to at least one, so that empty steps do not get infinite weight.
+        max_iter (int, optional): The largest number of iterations.
+        ftol (float, optional): Relative decrease of the chi squared below
+            which a pair has converged.
+        gtol (float, optional): Cosine between the residuals and the columns
+            of the Jacobian below which a pair has converged.
+
+    Returns:
+        tuple: The fitted parameters, pairs x 4, their covariance matrices,
+        pairs x 4 x 4, and whether each fit converged. As with
+        ``curve_fit(..., absolute_sigma=True)``, the covariances are not
+        rescaled by the chi squared.
+
+    Examples:
+        >>> params, covariances, converged = fit_hom(np.arange(1, 101), coinc_counts[:120])
+        >>> visibilities = params[:, 1]
+        >>> errors = np.sqrt(covariances[:, 1, 1])
+    """
+    y = np.array(counts, dtype=float, ndmin=2)
+    pairs, points = y.shape
+    x = np.broadcast_to(np.asarray(x, dtype=float), y.shape)
+    if sigma is None:
+        sigma = np.sqrt(np.maximum(y, 0))
+    weights = 1 / np.maximum(np.broadcast_to(sigma, y.shape), 1) ** 2
+    if p0 is None:
+        rows = np.arange(pairs)
+        p0 = np.stack((y.max(axis=1), np.full(pairs, 0.5), x[rows, y.argmin(axis=1)],
+                       (x.max(axis=1) - x.min(axis=1)) / 10), axis=1)
+    p = np.array(np.broadcast_to(p0, (pairs, 4)), dtype=float)
+
+    def normal_equations(x, y, weights, p):
+        """The chi squared, J^T W J and J^T W r at p."""
+        model, jacobian = _hom_model(x, p)
+        residuals = y - model
+        weighted = np.swapaxes(jacobian * weights[..., None], 1, 2)
+        return (np.sum(weights * residuals ** 2, axis=1), weighted @ jacobian,
+                (weighted @ residuals[..., None])[..., 0])
+
+    # Damping as in Nielsen's variant of Levenberg-Marquardt, relative to
+    # the largest diagonal of J^T J seen so far (Marquardt's scaling)
+    damping = np.full(pairs, 0.1)
+    growth = np.full(pairs, 2.0)
+    current, A, g = normal_equations(x, y, weights, p)
+    scaling = np.einsum('pii->pi', A).copy()
+    active = np.isfinite(current)
+    converged = np.zeros(pairs, dtype=bool)
+    for _ in range(max_iter):
+        idx = np.flatnonzero(active)
+        if idx.size == 0:
+            break
+        Ai, gi, ci = A[idx], g[idx], current[idx]
+
+        # Gradient test, as in MINPACK: no direction left to decrease along
+        norms = np.sqrt(np.maximum(np.einsum('pii->pi', Ai) * ci[:, None], 1e-300))
+        flat = np.max(np.abs(gi) / norms, axis=1) <= gtol
+
+        D = damping[idx, None] * scaling[idx]
+        damped = Ai.copy()
+        damped[:, range(4), range(4)] += D
+        step = _solve(damped, gi)
+        trial = p[idx] + step
+        new, new_A, new_g = normal_equations(x[idx], y[idx], weights[idx], trial)
+        # Gain ratio: actual over predicted decrease of the chi squared
+        predicted = np.sum(step * (D * step + gi), axis=1)
+        gain = (ci - new) / np.maximum(predicted, 1e-300)
+        better = np.isfinite(new) & (gain > 0)
+        small = better & (ci - new <= ftol * ci)
+
+        accepted = idx[better]
+        p[accepted] = trial[better]
+        current[accepted] = new[better]
+        A[accepted] = new_A[better]
+        g[accepted] = new_g[better]
+        scaling[accepted] = np.maximum(scaling[accepted], np.einsum('pii->pi', new_A[better]))
+        damping[idx] = np.where(better, damping[idx] * np.maximum(1 / 3, 1 - (2 * gain - 1) ** 3),
+                                damping[idx] * growth[idx])
+        growth[idx] = np.where(better, 2.0, growth[idx] * 2)
+        done = flat | small
+        converged[idx[done]] = True
+        # Steps that keep failing: give up on the pair
+        active[idx[done | (damping[idx] > 1e16)]] = False
+    converged &= np.all(np.isfinite(p), axis=1)
+
+    covariances = np.full((pairs, 4, 4), np.inf)
+    invertible = np.isfinite(A).all(axis=(1, 2)) & (np.linalg.matrix_rank(
+        np.where(np.isfinite(A), A, 0)) == 4)
+    covariances[invertible] = np.linalg.inv(A[invertible])
+    converged &= invertible
+    p[:, 3] = np.abs(p[:, 3])
+    return p, covariances, converged
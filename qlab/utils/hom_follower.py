@@ -0,0 +1,149 @@
+import os
+import time
+
+import numpy as np
+from .hom_fit import fit_hom
+from .hom_plot import _channel_tags, _tag_table, _parse_chunk, _line_chunks, _starting_parameters
+from .hom_analysis import _results_table
+
+class HOMFollower:
+    """Follows a coincidence file while a HOM scan is writing it.
+
+    Every call to :meth:`update` reads only the bytes appended since the
+    previous one, adds their records to the counts and refits only the pairs
+    whose counts changed, starting from their previous fit. An update thus
+    costs the same whatever the length of the file already read. The first
+    update reads the file written so far by ``chunk_size`` bytes, so its
+    memory is bounded whatever the length of the file.
+
+    Args:
+        file_name (str): The coincidence file, see
+            :func:`qlab.utils.load_coincidences`.
+        steps_number (int): The number of steps of the scan.
+        channels_number (int): The number of channels.
+        exclude_channels (list, optional): Channels whose pairs are skipped.
+        center (float, optional): The starting position of the first fits.
+            Default: the middle of the scan.
+        chunk_size (int, optional): The number of bytes read at once.
+
+    Attributes:
+        coinc_counts (array): The counts read so far, pairs x steps.
+        params (array): The last fitted ``(a, vis, x0, sigma)`` of every
+            pair, NaN before the first fit.
+        covariances (array): Their covariance matrices.
+        converged (array): Whether the last fit of every pair converged.
+
+    Examples:
+        >>> follower = HOMFollower('scan.txt', 100, 16)
+        >>> while scanning:
+        ...     changed = follower.update()
+        ...     print(follower.results()[changed][['tag', 'vis']])
+        ...     time.sleep(1)
+    """
+
+    def __init__(self, file_name, steps_number, channels_number, exclude_channels=[], center=-1,
+                 chunk_size=1 << 24):
+        self.file_name = file_name
+        self.chunk_size = chunk_size
+        self.steps_number = steps_number
+        self.center = steps_number/2 if center == -1 else center
+        self.tags = _channel_tags(channels_number, exclude_channels)
+        self._table = _tag_table(self.tags)
+        self._reset()
+
+    def _reset(self):
+        pairs = len(self.tags)
+        self.coinc_counts = np.zeros((pairs, self.steps_number), dtype=int)
+        self.params = np.full((pairs, 4), np.nan)
+        self.covariances = np.full((pairs, 4, 4), np.nan)
+        self.converged = np.zeros(pairs, dtype=bool)
+        self._stale = np.zeros(pairs, dtype=bool)
+        self._offset = 0
+        self._rest = b""
+        self._step = None
+        self._unknown = {}
+
+    def update(self):
+        """Reads the new lines of the file and refits the pairs they changed.
+
+        A line is only read once it is complete. If the file shrank, it was
+        rewritten: everything is read again.
+
+        Returns:
+            array: The indices of the refitted pairs.
+        """
+        delta = np.zeros_like(self.coinc_counts)
+        known = set(self._unknown)
+        try:
+            with open(self.file_name, 'rb') as coinc_file:
+                if os.fstat(coinc_file.fileno()).st_size < self._offset:
+                    self._reset()
+                coinc_file.seek(self._offset)
+                for lines, rest, size in _line_chunks(coinc_file, self.chunk_size, self._rest):
+                    # The position only moves on once the lines are parsed,
+                    # so that a failed update reads them again
+                    self._step = _parse_chunk(lines, self._table, delta, self._step, self._unknown)
+                    self._offset += size
+                    self._rest = rest
+        finally:
+            # The chunks parsed before a failure are kept, and refitted later
+            self.coinc_counts += delta
+            self._stale |= delta.any(axis=1)
+            for tag in self._unknown.keys() - known:
+                print("What? Key: " + tag)
+
+        changed = np.flatnonzero(self._stale)
+        self._stale[:] = False
+        if changed.size:
+            # The steps not reached yet are left out of the fits
+            steps = np.flatnonzero(self.coinc_counts.any(axis=0))[-1] + 1
+            counts = self.coinc_counts[changed, :steps]
+            # Start from the previous fits, where there is one
+            p0 = _starting_parameters(self.coinc_counts[changed], self.center)
+            warm = self.converged[changed]
+            p0[warm] = self.params[changed[warm]]
+            params, covariances, converged = fit_hom(np.arange(1, steps + 1), counts, p0)
+            self.params[changed] = params
+            self.covariances[changed] = covariances
+            self.converged[changed] = converged
+        return changed
+
+    def results(self):
+        """The current fits, as returned by :func:`qlab.utils.analyze_hom`."""
+        fitted = np.flatnonzero(~np.isnan(self.params[:, 0]))
+        return _results_table(self.tags, self.coinc_counts, fitted, self.params[fitted],
+                              self.covariances[fitted], self.converged[fitted])
+
+def follow_hom(file_name, steps_number, channels_number, exclude_channels=[], center=-1,
+               interval=1.0, timeout=None):
+    """Yields the HOM fits of a scan each time its coincidence file grows.
+
+    Args:
+        file_name (str): The coincidence file.
+        steps_number (int): The number of steps of the scan.
+        channels_number (int): The number of channels.
+        exclude_channels (list, optional): Channels whose pairs are skipped.
+        center (float, optional): The starting position of the first fits.
+        interval (float, optional): Seconds between two looks at the file.
+        timeout (float, optional): Stop once the file has not grown for this
+            many seconds. Default: follow forever.
+
+    Yields:
+        array: The fits of all the pairs, as returned by
+        :func:`qlab.utils.analyze_hom`, after each update changing some.
+
+    Examples:
+        Watch the visibility of the pair 01_02 during a scan
+
+        >>> for results in follow_hom('scan.txt', 100, 16, timeout=60):
+        ...     print(results[results['tag'] == '01_02']['vis'])
+    """
+    follower = HOMFollower(file_name, steps_number, channels_number, exclude_channels, center)
+    last_change = time.monotonic()
+    while True:
+        if follower.update().size:
+            last_change = time.monotonic()
+            yield follower.results()
+        elif timeout is not None and time.monotonic() - last_change > timeout:
+            return
+        time.sleep(interval)
@@ -1,74 +1,273 @@
+import json
+import os
+import tempfile
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy import optimize
-plt.style.use('ggplot')
+from .hom_fit import fit_hom
 
 def HOM_func(x, *p):
     a, vis, x0, sigma = p
     return a * (1 - vis * np.exp( - 4 * np.log(2) * ((x-x0) / sigma)**2))
 
+def _channel_tags(channels_number, exclude_channels=[]):
+    """The "NN_MM" tags of the channel pairs, in the order of the rows of
+    the coincidence counts."""
+    tags = []
+    for c1 in range(1, channels_number + 1):
+        for c2 in range(c1 + 1, channels_number + 1):
+            if c1 not in exclude_channels and c2 not in exclude_channels:
+                tags.append("%02d_%02d" % (c1, c2))
+    return tags
+
+def _tag_table(tags):
+    """Lookup table from the two channel numbers of a tag to its row, -1 for
+    the pairs that are not counted."""
+    table = np.full((100, 100), -1, dtype=np.intp)
+    for i, tag in enumerate(tags):
+        table[int(tag[:2]), int(tag[3:])] = i
+    return table
+
+_UNDERSCORE_TO_SPACE = bytes.maketrans(b"_", b" ")
+
+def _parse_chunk(data, table, coinc_counts, step=None, unknown=None):
+    """Adds the records of ``data``, whole lines of a coincidence file, to
+    ``coinc_counts``.
+
+    The file is a sequence of step markers, lines holding a step number, each
+    followed by "NN_MM count" records. With the underscores read as spaces,
+    every token is an integer, which NumPy parses in C in one call. The kind
+    of each token follows from its neighbours: the tokens around an
+    underscore are the channels of a tag, the next one is its count, and all
+    the others are step markers, which must be alone on their line.
+
+    Args:
+        data (bytes): The lines to parse.
+        table (array): The lookup table of the tags, see :func:`_tag_table`.
+        coinc_counts (array): The counts to update, pairs x steps.
+        step (int, optional): The step of the records before the first step
+            marker of ``data``.
+        unknown (dict, optional): Counts the occurrences of the tags that are
+            not in ``table``.
+
+    Returns:
+        The step of the last step marker, to parse the next chunk.
+    """
+    a = np.frombuffer(data, dtype=np.uint8)
+    inside = np.concatenate(([False], (a > 32) & (a != 95), [False]))
+    edges = np.flatnonzero(inside[1:] != inside[:-1])
+    starts, ends = edges[::2], edges[1::2]
+    if starts.size == 0:
+        return step
+    lengths = ends - starts
+    try:
+        values = np.fromstring(data.translate(_UNDERSCORE_TO_SPACE), dtype=np.int64, sep=" ")
+    except ValueError:
+        values = None
+    if values is None or values.size != starts.size:
+        raise ValueError("Coincidence data is not made of integers and tags.")
+
+    # Second channel of each tag: the tokens right after an underscore
+    second = np.flatnonzero(a[starts[1:] - 1] == 95) + 1
+    first = second - 1
+    counts = second + 1
+    if (second.size != np.count_nonzero(a == 95) or np.any(starts[second] - ends[first] != 1)
+            or counts.size and counts[-1] >= starts.size or np.any(np.diff(second) < 3)):
+        raise ValueError("Malformed coincidence record, expected \"NN_MM count\".")
+
+    # Step of every record: the value of the last step marker before it
+    is_step = np.ones(starts.size, dtype=bool)
+    is_step[first] = is_step[second] = is_step[counts] = False
+    markers = np.flatnonzero(is_step)
+    # A step marker is alone on its line: anything else is a stray token
+    line = np.searchsorted(np.flatnonzero(a == 10), starts)
+    alone = np.ones(starts.size + 1, dtype=bool)
+    alone[1:-1] = line[1:] != line[:-1]
+    if not np.all(alone[markers] & alone[markers + 1]):
+        raise ValueError("Malformed coincidence record, expected \"NN_MM count\".")
+    last = np.searchsorted(markers, first) - 1
+    if first.size and last[0] < 0 and step is None:
+        raise ValueError("Coincidence record before the first step marker.")
+    record_steps = np.where(last >= 0, values[np.append(markers, 0)[last]],
+                            -1 if step is None else step)
+    if np.any((record_steps < 0) | (record_steps >= coinc_counts.shape[1])):
+        raise IndexError("Step out of range for %d steps." % coinc_counts.shape[1])
+
+    # Tags "NN_MM" are looked up by their two channel numbers
+    c1, c2 = values[first], values[second]
+    rows = np.full(first.size, -1, dtype=np.intp)
+    well_formed = (lengths[first] == 2) & (lengths[second] == 2) & (c1 >= 0) & (c2 >= 0)
+    rows[well_formed] = table[c1[well_formed], c2[well_formed]]
+    known = rows >= 0
+    if unknown is not None and not np.all(known):
+        # Excluded channels can make millions of records: group them first
+        records = np.flatnonzero(~known)
+        spelling = np.stack((c1[records], c2[records], lengths[first[records]],
+                             lengths[second[records]]), axis=1)
+        _, index, occurrences = np.unique(spelling, axis=0, return_index=True, return_counts=True)
+        for i, n in zip(records[index], occurrences):
+            tag = data[starts[first[i]]:ends[second[i]]].decode(errors='replace')
+            unknown[tag] = unknown.get(tag, 0) + int(n)
+
+    flat = rows[known] * coinc_counts.shape[1] + record_steps[known]
+    coinc_counts += np.bincount(flat, weights=values[counts[known]],
+                                minlength=coinc_counts.size).astype(coinc_counts.dtype) \
+        .reshape(coinc_counts.shape)
+    return values[markers[-1]] if markers.size else step
+
+def _line_chunks(coinc_file, chunk_size, rest=b""):
+    """Reads ``coinc_file`` by ``chunk_size`` bytes and yields, for each
+    read, the whole lines read so far, the incomplete line after them and the
+    number of bytes read. ``rest`` is an incomplete line read before."""
+    while True:
+        chunk = coinc_file.read(chunk_size)
+        if not chunk:
+            return
+        data = rest + chunk
+        cut = data.rfind(b"\n") + 1
+        rest = data[cut:]
+        yield data[:cut], rest, len(chunk)
+
+def _sidecar_paths(file_name):
+    """The cached counts of a coincidence file and their description."""
+    return file_name + ".coinc.npy", file_name + ".coinc.json"
+
+def _atomic_write(path, write):
+    """Calls ``write(file)`` on a temporary file then moves it to ``path``,
+    so that readers never see a partial file."""
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(temp, path)
+    except BaseException:
+        os.remove(temp)
+        raise
+
+def _read_sidecar(file_name, parameters):
+    """The cached counts and unknown tags of ``file_name``, or None if there
+    are none for these parameters or the file changed since."""
+    npy_path, json_path = _sidecar_paths(file_name)
+    try:
+        with open(json_path) as f:
+            meta = json.load(f)
+        stat = os.stat(file_name)
+        if (meta['size'] != stat.st_size or meta['mtime_ns'] != stat.st_mtime_ns
+                or meta['parameters'] != parameters):
+            return None
+        coinc_counts = np.load(npy_path, mmap_mode='r')
+    except (OSError, ValueError, KeyError):
+        return None
+    return coinc_counts, meta['unknown']
+
+def _write_sidecar(file_name, parameters, stat, coinc_counts, tags, unknown):
+    """Caches the counts of ``file_name``; skipped if the directory is not
+    writable."""
+    npy_path, json_path = _sidecar_paths(file_name)
+    meta = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'parameters': parameters,
+            'tags': tags, 'unknown': unknown}
+    try:
+        # The description is written last and marks the counts as complete
+        if os.path.exists(json_path):
+            os.remove(json_path)
+        _atomic_write(npy_path, lambda f: np.save(f, coinc_counts))
+        _atomic_write(json_path, lambda f: f.write(json.dumps(meta, indent=1).encode()))
+    except OSError:
+        pass
+
+def load_coincidences(file_name, steps_number, channels_number, exclude_channels=[],
+                      chunk_size=1 << 24, cache=True):
+    """Reads the coincidence counts of a HOM scan.
+
+    The file is read in chunks of ``chunk_size`` bytes, each parsed with
+    vectorized NumPy operations, so multi-GB files are read at disk speed in
+    bounded memory. Tags of excluded or unknown channel pairs are reported
+    once each with the number of their records, and skipped.
+
+    The counts are then cached next to the file, in ``<file_name>.coinc.npy``
+    with a description in ``<file_name>.coinc.json``. Later calls with the
+    same parameters memory-map the cache instead of parsing the file again,
+    until the size or the modification time of the file changes.
+
+    Args:
+        file_name (str): The coincidence file, a step number on a line
+            followed by lines "NN_MM count" for the pairs of channels NN < MM.
+        steps_number (int): The number of steps of the scan.
+        channels_number (int): The number of channels.
+        exclude_channels (list, optional): Channels whose pairs are skipped.
+        chunk_size (int, optional): The number of bytes read at once.
+        cache (bool, optional): Whether to use and write the cache.
+            Default: True.
+
+    Returns:
+        array: The counts, ``channels_number * (channels_number - 1)`` x
+        ``steps_number``. Row ``i`` holds the pair of the ``i``-th tag of the
+        non-excluded pairs in lexicographic order, the other rows are zero.
+        Counts read from the cache are a read-only memory map.
+
+    Examples:
+        >>> coinc_counts = load_coincidences('scan.txt', 100, 16, exclude_channels=[3])
+    """
+    parameters = {'steps_number': int(steps_number), 'channels_number': int(channels_number),
+                  'exclude_channels': sorted(int(c) for c in exclude_channels)}
+    cached = _read_sidecar(file_name, parameters) if cache else None
+    if cached is not None:
+        coinc_counts, unknown = cached
+        for tag, occurrences in unknown.items():
+            print("What? Key: %s (%d records)" % (tag, occurrences))
+        return coinc_counts
+
+    tags = _channel_tags(channels_number, exclude_channels)
+    table = _tag_table(tags)
+    coinc_counts = np.zeros((channels_number * (channels_number - 1), steps_number), dtype=int)
+    unknown = {}
+    step = None
+    rest = b""
+    with open(file_name, 'rb') as coinc_file:
+        # Stat the file being read: if it grows meanwhile, the cache is stale
+        stat = os.fstat(coinc_file.fileno())
+        for lines, rest, _ in _line_chunks(coinc_file, chunk_size):
+            step = _parse_chunk(lines, table, coinc_counts, step, unknown)
+    step = _parse_chunk(rest, table, coinc_counts, step, unknown)
+    for tag, occurrences in unknown.items():
+        print("What? Key: %s (%d records)" % (tag, occurrences))
+    if cache:
+        _write_sidecar(file_name, parameters, stat, coinc_counts, tags, unknown)
+    return coinc_counts
+
+def _starting_parameters(coinc_counts, center):
+    """Starting (a, vis, x0, sigma) of the fits of the rows of
+    ``coinc_counts``: the largest count, 0.5, ``center`` and a tenth of the
+    number of steps."""
+    pairs, steps_number = coinc_counts.shape
+    return np.stack((np.max(coinc_counts, axis=1),
+                     np.full(pairs, 0.5),
+                     np.full(pairs, center),
+                     np.full(pairs, steps_number/10)), axis=1)
+
 def hom_plot(steps_number, channels_number, file_name,  exclude_channels = [], center = -1):
+    import matplotlib.pyplot as plt
+    plt.style.use('ggplot')
     if center == -1:
         center = steps_number/2
-    #create and populate the dictionary
-    channel_dict = {}
-    inv_channel_dict = {}
-
-    coinc_counts = np.zeros((channels_number*(channels_number-1), steps_number), dtype=int)
-    i = 0
-    for c1 in np.arange(1, channels_number + 1):
-        for c2 in np.arange(c1 + 1, channels_number + 1):
-                if (c1 not in exclude_channels and c2 not in exclude_channels):
-                    ch_tag = "%02d_%02d" % (c1,c2)
-                    channel_dict.update({ch_tag : i})
-                    inv_channel_dict.update({i : ch_tag})
-                    #ch_tag = "%d_%d" % (c1,c2)
-                    #channel_dict.update({ch_tag : i})
-                    #ch_tag = "%d_%d" % (c2,c1)
-                    #channel_dict.update({ch_tag : i})
-                    i += 1
-
-    #open the file
-    with open(file_name) as coinc_file:
-        #run through the file
-        for line in coinc_file:
-            #check if the line is a step marker
-            if (len(line.strip()) >= 1  and line.find("_") == -1):
-                step = int(line.strip())
-            elif len(line.strip()) > 1:
-                part_line = line.strip().partition(" ")
-                try:
-                    coinc_counts[channel_dict[part_line[0]], step] += int(part_line[-1])
-                except KeyError:
-                    print("What? Key: " + part_line[0])
-                    pass
-
-    for i in range(channels_number * (channels_number-1)) :
-        if (coinc_counts[i].sum() != 0):
-            starting_par = np.max(coinc_counts[i,...]), 0.5, center, steps_number/10
-            points = np.arange(1,steps_number + 1)
-            could_fit = True
-            try:
-                popt, pcov = optimize.curve_fit(f = HOM_func,
-                                             xdata = points,
-                                             ydata = coinc_counts[i],
-                                             p0 = starting_par,
-                                             sigma = np.sqrt(coinc_counts[i]),
-                                             absolute_sigma = True)
-            except RuntimeError:
-                could_fit = False
-                pass
-
-            print(inv_channel_dict[i])
-            plt.figure(figsize=(8,5))
-            if (could_fit):
-                print('x0 = %f | sigma = %f' % (popt[2], np.sqrt(pcov[2,2])))
-                print('vis = %f | sigma = %f' % (popt[1], np.sqrt(pcov[1,1])))
-                plt.plot(points, HOM_func(points, *popt), '--')
-                plt.plot((popt[2], popt[2]), (0, np.min(coinc_counts[i])/2), '--')
-
-            plt.errorbar(y = coinc_counts[i], x = points, yerr= np.sqrt(coinc_counts[i]), fmt='o', color='indianred')
-            plt.ylim(ymin = 0)
-            plt.ylabel('Coincidences')
-            plt.xlabel('Displacement')
-            plt.show()
+    coinc_counts = load_coincidences(file_name, steps_number, channels_number, exclude_channels)
+    inv_channel_dict = dict(enumerate(_channel_tags(channels_number, exclude_channels)))
+
+    # Fit all the pairs with counts at once
+    points = np.arange(1,steps_number + 1)
+    fitted = np.flatnonzero(coinc_counts.sum(axis=1) != 0)
+    params, covariances, converged = fit_hom(points, coinc_counts[fitted],
+                                             _starting_parameters(coinc_counts[fitted], center))
+
+    for i, popt, pcov, could_fit in zip(fitted, params, covariances, converged):
+        print(inv_channel_dict[i])
+        plt.figure(figsize=(8,5))
+        if (could_fit):
+            print('x0 = %f | sigma = %f' % (popt[2], np.sqrt(pcov[2,2])))
+            print('vis = %f | sigma = %f' % (popt[1], np.sqrt(pcov[1,1])))
+            plt.plot(points, HOM_func(points, *popt), '--')
+            plt.plot((popt[2], popt[2]), (0, np.min(coinc_counts[i])/2), '--')
+
+        plt.errorbar(y = coinc_counts[i], x = points, yerr= np.sqrt(coinc_counts[i]), fmt='o', color='indianred')
+        plt.ylim(ymin = 0)
+        plt.ylabel('Coincidences')
+        plt.xlabel('Displacement')
+        plt.show()
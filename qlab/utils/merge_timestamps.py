@@ -0,0 +1,177 @@
+import numpy as np
+from .timestamps import TIMESTAMP_DTYPE, iter_timestamps
+
+def _reference_times(file_name, reference_channel, chunk_size):
+    """The timestamps of the reference channel of a file."""
+    return np.concatenate([chunk['timestamp'][chunk['channel'] == reference_channel]
+                           for chunk in iter_timestamps(file_name, chunk_size)] +
+                          [np.empty(0, dtype=np.int64)])
+
+def _corrected(timestamps, clock):
+    """Timestamps of a box on the timebase of the first box."""
+    offset, drift = clock
+    if offset == 0 and drift == 0:
+        return np.asarray(timestamps, dtype=np.int64)
+    return timestamps + np.rint(offset + drift * timestamps).astype(np.int64)
+
+def fit_clock(reference, times, tolerance=100, max_offset=10**9, max_drift=1e-4,
+              coarse_events=16):
+    """Fits the clock of a box to the clock of a reference box.
+
+    Both boxes record the same pulses on a reference channel. The offset is
+    first found from the most frequent difference between the first pulses of
+    the box and the reference pulses at most ``max_offset`` away, binned
+    coarsely enough for the drift over these pulses. Pulses are then matched
+    to the nearest reference pulse from where the current clock model puts
+    them, and the model fitted by least squares, on a span of pulses doubled
+    at every round so that the error of the drift never moves a pulse out of
+    the tolerance.
+
+    Args:
+        reference (array): The pulses on the timebase of the reference box.
+        times (array): The same pulses on the timebase of the box.
+        tolerance (int, optional): The largest distance between matched
+            pulses, larger than their jitter.
+        max_offset (int, optional): The largest offset between the boxes.
+        max_drift (float, optional): The largest relative drift between
+            the clocks. Default: 100 ppm.
+        coarse_events (int, optional): The number of pulses used to find
+            the offset.
+
+    Returns:
+        tuple: ``(offset, drift)``, such that ``t + offset + drift * t`` is
+        the time ``t`` of the box on the timebase of the reference box.
+
+    Raises:
+        ValueError: If the pulses cannot be matched.
+    """
+    reference = np.asarray(reference, dtype=np.int64)
+    times = np.asarray(times, dtype=np.int64)
+    if reference.size < 2 or times.size < 2:
+        raise ValueError("Too few reference pulses.")
+
+    # Offset: the most frequent difference, within the drift over the first pulses
+    first = times[:coarse_events]
+    width = int(tolerance + max_drift * (first[-1] - first[0]))
+    low = np.searchsorted(reference, first - max_offset, 'left')
+    high = np.searchsorted(reference, first + max_offset, 'right')
+    differences = np.concatenate([reference[l:h] - t for t, l, h in zip(first, low, high)] +
+                                 [np.empty(0, dtype=np.int64)])
+    if differences.size == 0:
+        raise ValueError("No reference pulses within %d of each other." % max_offset)
+    bins, occurrences = np.unique(differences // width, return_counts=True)
+    mode = bins[np.argmax(occurrences)]
+    near = differences[np.abs(differences // width - mode) <= 1]
+    offset, drift = float(np.median(near)), 0.0
+
+    span = max(int(first[-1] - first[0]), 1)
+    distance = 2 * width
+    while True:
+        used = times[:np.searchsorted(times, times[0] + span, 'right')]
+        predicted = _corrected(used, (offset, drift))
+        nearest = np.clip(np.searchsorted(reference, predicted), 1, reference.size - 1)
+        before, after = reference[nearest - 1], reference[nearest]
+        matched = np.where(predicted - before < after - predicted, before, after)
+        good = np.abs(matched - predicted) <= distance
+        if np.count_nonzero(good) < 2:
+            raise ValueError("Too few reference pulses matched.")
+        # Least squares of the difference of the clocks, centred for accuracy
+        x = used[good].astype(float)
+        y = (matched[good] - used[good]).astype(float)
+        center = x.mean()
+        if np.ptp(x) > 0:
+            drift = float(np.dot(x - center, y - y.mean()) / np.dot(x - center, x - center))
+        offset = float(y.mean() - drift * center)
+        if used.size == times.size:
+            return offset, drift
+        span *= 2
+        distance = tolerance
+
+def fit_clocks(file_names, reference_channel, tolerance=100, max_offset=10**9, max_drift=1e-4,
+               chunk_size=1 << 22):
+    """Fits the clocks of several ID800s to the clock of the first one.
+
+    Args:
+        file_names (list): The timestamp file of each box, as written by
+            :meth:`qlab.controllers.IDQ800.run_acquisition`.
+        reference_channel (int): The channel, numbered from 0, that records
+            the same pulses on every box.
+        tolerance (int, optional): The largest distance between matched
+            pulses, see :func:`fit_clock`.
+        max_offset (int, optional): The largest offset between the boxes.
+        max_drift (float, optional): The largest relative drift between
+            the clocks.
+        chunk_size (int, optional): The number of events read at once.
+
+    Returns:
+        array: The ``(offset, drift)`` of each box, zero for the first one.
+
+    Examples:
+        >>> clocks = fit_clocks(['timestamps1.bin', 'timestamps2.bin'], reference_channel=7)
+    """
+    clocks = np.zeros((len(file_names), 2))
+    reference = _reference_times(file_names[0], reference_channel, chunk_size)
+    for box, file_name in enumerate(file_names[1:], 1):
+        clocks[box] = fit_clock(reference, _reference_times(file_name, reference_channel, chunk_size),
+                                tolerance, max_offset, max_drift)
+    return clocks
+
+def merge_timestamps(file_names, clocks=None, box_channels=8, chunk_size=1 << 20):
+    """Merges the timestamp files of several ID800s in a single stream.
+
+    The files are read chunk by chunk, their timestamps taken to the
+    timebase of the first box, and the events of all the boxes up to the
+    earliest last buffered event of a box merged and yielded, so that at
+    most one chunk per box is in memory whatever the length of the run.
+
+    Args:
+        file_names (list): The timestamp file of each box.
+        clocks (array, optional): The ``(offset, drift)`` of each box, as
+            returned by :func:`fit_clocks`. Default: the same clock.
+        box_channels (int, optional): The number of channels of a box: the
+            channel ``c`` of the box ``b`` becomes ``b * box_channels + c``.
+        chunk_size (int, optional): The number of events read at once from
+            each file.
+
+    Yields:
+        array: Consecutive chunks of the events of all the boxes, in time
+        order, of dtype :data:`qlab.utils.timestamps.TIMESTAMP_DTYPE`.
+
+    Examples:
+        Coincidences between the channels of two boxes
+
+        >>> files = ['timestamps1.bin', 'timestamps2.bin']
+        >>> events = merge_timestamps(files, fit_clocks(files, reference_channel=7))
+        >>> counts = coincidence_counts(events, 25, channels_number=16)
+    """
+    if clocks is None:
+        clocks = np.zeros((len(file_names), 2))
+    sources = [iter_timestamps(file_name, chunk_size) for file_name in file_names]
+    empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint16))
+    buffers = [empty] * len(sources)
+    live = set(range(len(sources)))
+    while True:
+        for box in sorted(live):
+            while buffers[box][0].size == 0:
+                chunk = next(sources[box], None)
+                if chunk is None:
+                    live.discard(box)
+                    break
+                buffers[box] = (_corrected(chunk['timestamp'], clocks[box]),
+                                (chunk['channel'] + box * box_channels).astype(np.uint16))
+        if not any(t.size for t, _ in buffers):
+            return
+        # Later events of a live box come after its last buffered one
+        horizon = min(buffers[box][0][-1] for box in live) if live else None
+        times, channels = [], []
+        for box, (t, ch) in enumerate(buffers):
+            cut = t.size if horizon is None else np.searchsorted(t, horizon, 'right')
+            times.append(t[:cut])
+            channels.append(ch[:cut])
+            buffers[box] = (t[cut:], ch[cut:])
+        times = np.concatenate(times)
+        order = np.argsort(times, kind='stable')
+        events = np.empty(times.size, dtype=TIMESTAMP_DTYPE)
+        events['timestamp'] = times[order]
+        events['channel'] = np.concatenate(channels)[order]
+        yield events
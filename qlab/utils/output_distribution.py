@@ -0,0 +1,137 @@
+import numpy as np
+from math import comb, factorial
+from .permanent import permanents
+
+# Number of subsets handled at once when building a layer of the expansion
+_CHUNK = 1 << 15
+
+def _binomial_table(m, n):
+    """Table of binomial coefficients C(c, i) for 0 <= c <= m, 0 <= i <= n.
+
+    Coefficients beyond the int64 range are clipped to its largest value,
+    which keeps the columns sorted for the unranking of ranks below it.
+    """
+    largest = np.iinfo(np.int64).max
+    table = np.zeros((m + 1, n + 1), dtype=np.int64)
+    table[:, 0] = 1
+    for c in range(1, m + 1):
+        # The sum of two int64 does not overflow in uint64
+        table[c, 1:] = np.minimum(table[c - 1, 1:].astype(np.uint64)
+                                  + table[c - 1, :-1].astype(np.uint64), largest)
+    return table
+
+def _unrank(ranks, k, binom):
+    """The k-subsets with the given colexicographic ranks, as sorted rows."""
+    ranks = ranks.copy()
+    subsets = np.empty((len(ranks), k), dtype=np.intp)
+    for i in range(k, 0, -1):
+        c = np.searchsorted(binom[:, i], ranks, side='right') - 1
+        subsets[:, i - 1] = c
+        ranks -= binom[c, i]
+    return subsets
+
+def _laplace_amplitudes(V, binom):
+    """Permanents of V[S] for all the n-subsets S of the rows of the m x n
+    matrix V, in colexicographic order.
+
+    Layer k holds the permanents of the k x k submatrices with rows S and
+    the first k columns, obtained from layer k-1 by a Laplace expansion
+    along column k-1: each is shared by all the outputs that contain S.
+    """
+    m, n = V.shape
+    layer = V[:, 0].copy()
+    for k in range(2, n + 1):
+        size = binom[m, k]
+        new_layer = np.empty(size, dtype=complex)
+        positions = np.arange(k)
+        for start in range(0, size, _CHUNK):
+            stop = min(start + _CHUNK, size)
+            subsets = _unrank(np.arange(start, stop), k, binom)
+            # Rank of the subset without its j-th element
+            up = binom[subsets, positions + 1]
+            down = binom[subsets, positions]
+            minors = (np.cumsum(up, axis=1) - up
+                      + np.cumsum(down[:, ::-1], axis=1)[:, ::-1] - down)
+            new_layer[start:stop] = np.einsum('ij,ij->i', V[subsets, k - 1], layer[minors])
+        layer = new_layer
+    return layer
+
+def _batched_amplitudes(V, binom, budget, threads):
+    """Same as `_laplace_amplitudes`, with one permanent per output evaluated
+    in batches that fit in ``budget`` bytes."""
+    m, n = V.shape
+    size = binom[m, n]
+    amplitudes = np.empty(size, dtype=complex)
+    chunk = max(1, min(_CHUNK, budget // (2 * n * np.dtype(np.intp).itemsize + 16)))
+    for start in range(0, size, chunk):
+        stop = min(start + chunk, size)
+        rows = _unrank(np.arange(start, stop), n, binom)
+        cols = np.broadcast_to(np.arange(n), rows.shape)
+        amplitudes[start:stop] = permanents(V, rows, cols, threads=threads)
+    return amplitudes
+
+def output_distribution(U, input_modes, max_memory=1 << 30, threads=1):
+    """Probabilities of all the collision-free outputs of a boson sampler.
+
+    Photons enter the modes ``input_modes`` of the interferometer ``U``,
+    whose element ``U[i, j]`` is the amplitude from input mode ``j`` to output
+    mode ``i``. The probability of the output modes ``S`` is
+    ``|perm(U[S][:, input_modes])|**2`` over the product of the factorials of
+    the input occupations.
+
+    The permanents are built up one photon at a time with a Laplace expansion,
+    reusing the sub-permanents shared by different outputs: the whole table
+    costs about ``sum_k C(m, k) k`` operations instead of ``C(m, n)``
+    permanents. If the intermediate tables do not fit in ``max_memory``, the
+    outputs are evaluated in batches with :func:`permanents` instead.
+
+    Args:
+        U (array): The m x m unitary of the interferometer.
+        input_modes (sequence of int): The input mode of each photon. A mode
+            may appear more than once.
+        max_memory (int, optional): Memory cap in bytes for the result and the
+            intermediate tables. Default: 1 GiB.
+        threads (int, optional): The number of native threads used by the
+            batched fallback. Default: 1.
+
+    Returns:
+        array: The probabilities of the outputs, in the order of
+        ``itertools.combinations(range(m), n)``.
+
+    Raises:
+        MemoryError: If the result alone does not fit in ``max_memory``.
+
+    Examples:
+        Two photons on a balanced beam splitter never exit in different modes
+
+        >>> U = np.array([[1, 1], [1, -1]]) / np.sqrt(2)
+        >>> output_distribution(U, [0, 1])
+        array([0.])
+    """
+    U = np.asarray(U, dtype=complex)
+    if U.ndim != 2:
+        raise ValueError("U must be a matrix.")
+    input_modes = np.asarray(input_modes, dtype=np.intp)
+    m, n = U.shape[0], len(input_modes)
+    if n == 0:
+        return np.ones(1)
+
+    norm = float(np.prod([factorial(c) for c in np.bincount(input_modes)]))
+    # Sizes in Python integers: they can be far beyond the int64 range
+    size = comb(m, n)
+    if size * 8 > max_memory:
+        raise MemoryError('The %d outputs do not fit in max_memory.' % size)
+    if size == 0:
+        return np.zeros(0)
+    binom = _binomial_table(m, n)
+
+    # Enumerating subsets of the reversed rows in colexicographic order gives
+    # the subsets of the rows in lexicographic order, backwards.
+    V = U[::-1, input_modes]
+    workspace = _CHUNK * n * 6 * np.dtype(np.intp).itemsize
+    tables = max(comb(m, k - 1) + comb(m, k) for k in range(1, n + 1)) * 16
+    if size * 8 + tables + workspace <= max_memory:
+        amplitudes = _laplace_amplitudes(V, binom)
+    else:
+        amplitudes = _batched_amplitudes(V, binom, max_memory - size * 8, threads)
+    return (np.abs(amplitudes) ** 2 / norm)[::-1]
@@ -0,0 +1,59 @@
+import numpy as np
+
+def permanent_approx(M, samples=100000, seed=None, rtol=None, block=4096):
+    """Randomized estimate of the permanent of a matrix (Gurvits' estimator).
+
+    For a vector ``x`` of independent random signs,
+    ``prod(x) * prod(x @ M)`` is an unbiased estimate of the permanent of
+    ``M`` (Glynn's formula). Sign vectors are drawn in blocks and each block
+    is evaluated with a single matrix-matrix product, so the cost is
+    ``O(samples n^2)`` whatever the size of the matrix: use it for matrices
+    too large for :func:`permanent`. The standard error is of order
+    ``||M||**n / sqrt(samples)``, so the estimate is useful for submatrices of
+    unitaries and other matrices with norm at most one.
+
+    Args:
+        M (array): The n x n matrix, real or complex.
+        samples (int, optional): The largest number of sign vectors to draw.
+        seed (optional): Seed or ``numpy.random.Generator`` for the random
+            numbers.
+        rtol (float, optional): Stop as soon as the standard error is below
+            ``rtol`` times the absolute value of the estimate.
+            Default: always draw ``samples`` vectors.
+        block (int, optional): The number of sign vectors per block.
+
+    Returns:
+        tuple: The estimate of the permanent and its standard error.
+
+    Examples:
+        Estimate the permanent of a 40 x 40 submatrix of a unitary
+
+        >>> U = np.fft.fft(np.eye(64)) / 8
+        >>> estimate, error = permanent_approx(U[:40, :40], samples=10**6, seed=0)
+    """
+    M = np.asarray(M)
+    if M.ndim != 2 or M.shape[0] != M.shape[1]:
+        raise ValueError("M must be a square matrix.")
+    M = M.astype(complex if np.iscomplexobj(M) else float)
+    n = M.shape[0]
+    if n == 0:
+        return M.dtype.type(1), 0.0
+    rng = np.random.default_rng(seed)
+
+    total, total_sq, drawn = 0, 0.0, 0
+    estimate, error = M.dtype.type(0), np.inf
+    while drawn < samples:
+        size = min(block, samples - drawn)
+        signs = (1 - 2 * rng.integers(0, 2, size=(size, n), dtype=np.int8)).astype(M.real.dtype)
+        values = np.prod(signs, axis=1) * np.prod(signs @ M, axis=1)
+        total += values.sum()
+        total_sq += np.sum(np.abs(values) ** 2)
+        drawn += size
+
+        estimate = total / drawn
+        if drawn > 1:
+            variance = max(total_sq / drawn - abs(estimate) ** 2, 0.0) * drawn / (drawn - 1)
+            error = np.sqrt(variance / drawn)
+        if rtol is not None and error <= rtol * abs(estimate):
+            break
+    return estimate, error
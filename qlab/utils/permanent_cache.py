@@ -0,0 +1,163 @@
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from .permanent_lowrank import permanent
+
+# Rough memory used by an entry besides its key and value: the OrderedDict
+# node and the size bookkeeping
+_ENTRY_OVERHEAD = 100
+
+class PermanentCache:
+    """An opt-in memoization cache for :func:`qlab.utils.permanent`.
+
+    Results are keyed by a fast hash of the cached function and of the
+    matrix bytes, dtype and shape (and of the multiplicities, if any), so
+    identical submatrices met again during a parameter scan are not
+    recomputed. The in-memory tier is an LRU bounded in bytes. An optional on-disk tier, an SQLite database, keeps the
+    expensive results across runs.
+
+    Args:
+        max_bytes (int, optional): The memory bound of the in-memory tier.
+            Default: 64 MiB.
+        path (str, optional): The SQLite file of the on-disk tier.
+            Default: no on-disk tier.
+        disk_min_n (int, optional): Only matrices at least this large are
+            stored on disk, where a lookup costs more than small permanents.
+            Default: 16.
+        function (callable, optional): The permanent function to cache.
+            Default: :func:`qlab.utils.permanent`.
+
+    Examples:
+        Cache the permanents of a scan on disk
+
+        >>> cache = PermanentCache(path='permanents.sqlite')
+        >>> p = cache(U[rows][:, cols])
+        >>> cache.stats()
+        {'hits': 0, 'misses': 1, 'disk_hits': 0, 'evictions': 0, 'entries': 1, 'bytes': 185}
+
+        Keyword arguments are passed on to the permanent function
+
+        >>> p = cache(M, threads=8)
+    """
+
+    def __init__(self, max_bytes=64 << 20, path=None, disk_min_n=16, function=permanent):
+        self._max_bytes = max_bytes
+        self._function = function
+        self._disk_min_n = disk_min_n
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+
+        self._db = None
+        if path is not None:
+            directory = os.path.dirname(os.path.abspath(path))
+            os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS permanents '
+                             '(key BLOB PRIMARY KEY, re REAL, im REAL, complex INTEGER)')
+            self._db.commit()
+
+    def key(self, M, **kwargs):
+        """The cache key of ``M`` and the keyword arguments that change the
+        result. ``threads`` does not. The cached function is part of the key,
+        so that caches of different functions can share an on-disk tier."""
+        M = np.ascontiguousarray(M)
+        digest = hashlib.blake2b(digest_size=20)
+        function = self._function
+        digest.update(('%s.%s' % (getattr(function, '__module__', ''),
+                                  getattr(function, '__qualname__', repr(function)))).encode())
+        digest.update(('%s%r' % (M.dtype.str, M.shape)).encode())
+        digest.update(M.data)
+        for name in sorted(kwargs):
+            if name == 'threads' or kwargs[name] is None:
+                continue
+            value = np.ascontiguousarray(kwargs[name])
+            digest.update(('%s%s%r' % (name, value.dtype.str, value.shape)).encode())
+            digest.update(value.data)
+        return digest.digest()
+
+    def __call__(self, M, **kwargs):
+        key = self.key(M, **kwargs)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+
+        value = self._disk_get(key)
+        if value is not None:
+            with self._lock:
+                self.disk_hits += 1
+                self._store(key, value)
+            return value
+
+        value = self._function(M, **kwargs)
+        with self._lock:
+            self.misses += 1
+            self._store(key, value)
+        if np.ndim(M) == 2 and np.shape(M)[0] >= self._disk_min_n:
+            self._disk_put(key, value)
+        return value
+
+    def _store(self, key, value):
+        if key in self._entries:
+            return
+        self._entries[key] = value
+        self._bytes += sys.getsizeof(key) + sys.getsizeof(value) + _ENTRY_OVERHEAD
+        while self._bytes > self._max_bytes and self._entries:
+            old_key, old_value = self._entries.popitem(last=False)
+            self._bytes -= sys.getsizeof(old_key) + sys.getsizeof(old_value) + _ENTRY_OVERHEAD
+            self.evictions += 1
+
+    def _disk_get(self, key):
+        if self._db is None:
+            return None
+        with self._lock:
+            row = self._db.execute('SELECT re, im, complex FROM permanents WHERE key = ?',
+                                   (key,)).fetchone()
+        if row is None:
+            return None
+        return complex(row[0], row[1]) if row[2] else row[0]
+
+    def _disk_put(self, key, value):
+        if self._db is None:
+            return
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO permanents VALUES (?, ?, ?, ?)',
+                             (key, float(np.real(value)), float(np.imag(value)),
+                              int(isinstance(value, complex))))
+            self._db.commit()
+
+    def stats(self):
+        """The hit and miss counters and the size of the in-memory tier."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'disk_hits': self.disk_hits,
+                    'evictions': self.evictions, 'entries': len(self._entries),
+                    'bytes': self._bytes}
+
+    def clear(self, disk=False):
+        """Empties the in-memory tier, and the on-disk one if ``disk``."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            if disk and self._db is not None:
+                self._db.execute('DELETE FROM permanents')
+                self._db.commit()
+
+    def close(self):
+        """Closes the on-disk tier."""
+        if getattr(self, '_db', None) is not None:
+            self._db.close()
+            self._db = None
+
+    def __del__(self):
+        self.close()
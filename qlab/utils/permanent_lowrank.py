@@ -0,0 +1,136 @@
+import numpy as np
+from math import factorial
+from .permanent import permanent as _glynn_permanent
+
+# Below this size Glynn's formula is faster than checking the rank
+_LOWRANK_MIN_N = 16
+# Largest size in bytes of the coefficient arrays of the low rank path:
+# beyond it Glynn's formula is used whatever the rank
+_LOWRANK_MAX_MEMORY = 1 << 28
+
+def _linear_forms_product(A):
+    """Coefficients of prod_i (sum_k A[i, k] t_k), with t_r = 1.
+
+    The result is an (n+1, ..., n+1) array over the exponents of
+    t_1 ... t_(r-1); the exponent of t_r is n minus their sum.
+    """
+    n, r = A.shape
+    coefficients = np.zeros((n + 1,) * (r - 1), dtype=A.dtype)
+    coefficients[(0,) * (r - 1)] = 1
+    for i in range(n):
+        product = A[i, r - 1] * coefficients
+        for k in range(r - 1):
+            # Multiply by t_k: shift by one along axis k
+            target = [slice(None)] * (r - 1)
+            source = [slice(None)] * (r - 1)
+            target[k] = slice(1, None)
+            source[k] = slice(None, -1)
+            product[tuple(target)] += A[i, k] * coefficients[tuple(source)]
+        coefficients = product
+    return coefficients
+
+def permanent_lowrank(U, V):
+    """The permanent of the product of an n x r and an r x n matrix.
+
+    By the Cauchy-Binet formula for permanents,
+    ``perm(U @ V) = sum_m m! c_U(m) c_V(m)`` over the multisets ``m`` of size
+    ``n`` of the ``r`` columns, where ``c_U(m)`` is the coefficient of
+    ``t**m`` in ``prod_i (U[i] @ t)`` and similarly for ``V``. Both
+    polynomials are expanded one factor at a time, which costs
+    ``O(n r (n+1)**(r-1))``: polynomial in ``n`` for a fixed rank, so that
+    for example ``n = 40`` with ``r = 3`` takes milliseconds. The
+    coefficients take ``(n+1)**(r-1)`` entries each, so large ranks run out
+    of memory long before they run out of time.
+
+    Args:
+        U (array): The n x r left factor.
+        V (array): The r x n right factor.
+
+    Returns:
+        The permanent of ``U @ V``, complex if either factor is.
+
+    Examples:
+        The all-ones matrix has rank one and permanent n!
+
+        >>> permanent_lowrank(np.ones((40, 1)), np.ones((1, 40)))
+        8.159152832478977e+47
+    """
+    U = np.asarray(U)
+    V = np.asarray(V)
+    if U.ndim != 2 or V.ndim != 2 or U.shape[1] != V.shape[0] or U.shape[0] != V.shape[1]:
+        raise ValueError("U and V must be n x r and r x n matrices.")
+    dtype = complex if np.iscomplexobj(U) or np.iscomplexobj(V) else float
+    n, r = U.shape
+    if n == 0:
+        return dtype(1)
+    if r == 0:
+        return dtype(0)
+
+    coefficients = _linear_forms_product(U.astype(dtype)) * _linear_forms_product(V.T.astype(dtype))
+    # Weight each multiset by prod_k m_k!, m_r being what is left of n, with
+    # one array over the exponents built by broadcasting
+    factorials = np.array([factorial(k) for k in range(n + 1)], dtype=float)
+    exponents = np.zeros((), dtype=np.intp)
+    weights = np.ones(())
+    for k in range(r - 1):
+        shape = [1] * (r - 1)
+        shape[k] = n + 1
+        exponents = exponents + np.arange(n + 1).reshape(shape)
+        weights = weights * factorials.reshape(shape)
+    weights = weights * factorials[np.clip(n - exponents, 0, n)] * (exponents <= n)
+    return dtype(np.sum(weights * coefficients))
+
+def lowrank_factors(M, rtol=None):
+    """Factors ``U``, ``V`` with ``U @ V`` equal to ``M`` up to rounding.
+
+    The rank is the number of singular values above ``rtol`` times the
+    largest one.
+
+    Args:
+        M (array): The matrix to factor.
+        rtol (float, optional): Relative threshold on the singular values.
+            Default: the size of the matrix times the machine epsilon, as in
+            ``numpy.linalg.matrix_rank``.
+
+    Returns:
+        tuple: The n x r and r x n factors.
+    """
+    M = np.asarray(M)
+    u, s, vh = np.linalg.svd(M)
+    if rtol is None:
+        rtol = max(M.shape) * np.finfo(s.dtype).eps
+    rank = int(np.sum(s > rtol * s[0])) if s.size else 0
+    return u[:, :rank] * s[:rank], vh[:rank]
+
+def permanent(M, row_mult=None, col_mult=None, threads=1, lowrank=True):
+    """Evaluates the permanent of a real or complex matrix.
+
+    This wraps the compiled ``qlab.utils.permanent.permanent``. For
+    square matrices of size 16 or more without multiplicities, the numerical
+    rank is checked first and numerically low rank matrices are evaluated
+    with :func:`permanent_lowrank` when that is cheaper than Glynn's formula
+    and its coefficients fit in 256 MiB.
+
+    Args:
+        M (array): The matrix.
+        row_mult (array, optional): How many times each row is repeated.
+        col_mult (array, optional): How many times each column is repeated.
+        threads (int, optional): The number of native threads. Default: 1.
+        lowrank (bool, optional): Whether to check for low rank. Default: True.
+
+    Returns:
+        The permanent, a float for real matrices and complex otherwise.
+    """
+    if (lowrank and row_mult is None and col_mult is None and isinstance(M, np.ndarray)
+            and M.ndim == 2 and M.shape[0] == M.shape[1] and M.shape[0] >= _LOWRANK_MIN_N
+            and M.dtype.kind in 'biufc' and np.all(np.isfinite(M))):
+        n = M.shape[0]
+        U, V = lowrank_factors(M)
+        r = U.shape[1]
+        entries = float(n + 1) ** max(r - 1, 0)
+        # Four arrays of coefficients: the two products, their temporaries
+        # and the weights
+        if (r < n and n * max(r, 1) * entries < 2.0 ** (n - 1) * n / 4
+                and 4 * entries * np.dtype(complex).itemsize <= _LOWRANK_MAX_MEMORY):
+            return permanent_lowrank(U, V)
+    return _glynn_permanent(M, row_mult=row_mult, col_mult=col_mult, threads=threads)
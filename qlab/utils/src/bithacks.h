@@ -1,14 +1,37 @@
-// Count the number of set bits in a binary string
-int countbits(unsigned int n)
+#include <stdint.h>
+
+#if defined(_MSC_VER)
+#include <intrin.h>
+#endif
+
+// Index of the lowest set bit of a non-zero 64 bit integer.
+// In a Gray code walk, this is the bit that flips between k-1 and k.
+static inline int lowest_bit(uint64_t k)
 {
-    int q=n;
-    q = (q & 0x5555555555555555) + ((q & 0xAAAAAAAAAAAAAAAA) >> 1);
-    q = (q & 0x3333333333333333) + ((q & 0xCCCCCCCCCCCCCCCC) >> 2);
-    q = (q & 0x0F0F0F0F0F0F0F0F) + ((q & 0xF0F0F0F0F0F0F0F0) >> 4);
-    q = (q & 0x00FF00FF00FF00FF) + ((q & 0xFF00FF00FF00FF00) >> 8);
-    q = (q & 0x0000FFFF0000FFFF) + ((q & 0xFFFF0000FFFF0000) >> 16);
-    q = (q & 0x00000000FFFFFFFF) + ((q & 0xFFFFFFFF00000000) >> 32); // This last & isn't strictly qecessary.
-    return q;
+#if defined(__GNUC__) || defined(__clang__)
+    return __builtin_ctzll(k);
+#elif defined(_MSC_VER) && defined(_WIN64)
+    unsigned long i;
+    _BitScanForward64(&i, k);
+    return (int) i;
+#else
+    int i = 0;
+    while ((k & 1) == 0) { k >>= 1; ++i; }
+    return i;
+#endif
 }
 
-int bitparity (unsigned int n) { return 1 - (countbits(n) & 1)*2; }
+// Reflected binary Gray code of k.
+static inline uint64_t gray_code(uint64_t k) { return k ^ (k >> 1); }
+
+// Number of set bits of a 64 bit integer.
+static inline int popcount(uint64_t k)
+{
+#if defined(__GNUC__) || defined(__clang__)
+    return __builtin_popcountll(k);
+#else
+    int c = 0;
+    while (k) { k &= k - 1; ++c; }
+    return c;
+#endif
+}
@@ -1,46 +1,81 @@
-// Array access macros.
-#define SM(x0, x1) (npy_complex128*) (((char *)PyArray_DATA(submatrix) + \
-                    (x0) * PyArray_STRIDES(submatrix)[0] +  \
-                    (x1) * PyArray_STRIDES(submatrix)[1]))
-#define SM_shape(x0) (int) PyArray_DIM(submatrix, x0)
+#include <string.h>
 
-// Complex numbers
-static const npy_complex128 complex_one = {.real=1, .imag=0};
-static const npy_complex128 complex_zero = {.real=0, .imag=0};
+// Matrix readers.
+// The kernels work on contiguous, row major buffers of doubles holding the
+// real and the imaginary parts, which the compiler can vectorize. The readers
+// below fill them straight from the input array, whatever its dtype and
+// strides, with fast paths for C and Fortran contiguous data.
+// Complex elements are read as two consecutive values, which is the memory
+// layout of npy_complex128/npy_complex64 on every NumPy version.
 
-// Add two numbers
-npy_complex128 complex_add(npy_complex128 a, npy_complex128 b) {
-    npy_complex128 x;
-    x.real = a.real+b.real;
-    x.imag = a.imag+b.real;
-    return x;
+#define DEFINE_MATRIX_READER(name, ctype, parts)                                  \
+static void name(PyArrayObject *a, double *re, double *im) {                      \
+    npy_intp rows = PyArray_DIM(a, 0), cols = PyArray_DIM(a, 1);                  \
+    npy_intp s0 = PyArray_STRIDE(a, 0), s1 = PyArray_STRIDE(a, 1);                \
+    npy_intp size = (npy_intp) (parts * sizeof(ctype));                           \
+    const char *data = PyArray_BYTES(a);                                          \
+    npy_intp i, j;                                                                \
+    if ((s1 == size || cols <= 1) && (s0 == cols * size || rows <= 1)) {         \
+        const ctype *p = (const ctype *) data;                                    \
+        for (i=0; i<rows*cols; ++i) {                                             \
+            re[i] = (double) p[parts*i];                                          \
+            if (im != NULL) { im[i] = parts == 2 ? (double) p[parts*i+1] : 0; }   \
+        }                                                                         \
+    } else if ((s0 == size || rows <= 1) && (s1 == rows * size || cols <= 1)) {   \
+        const ctype *p = (const ctype *) data;                                    \
+        for (j=0; j<cols; ++j) {                                                  \
+            for (i=0; i<rows; ++i) {                                              \
+                re[i*cols+j] = (double) p[parts*(j*rows+i)];                      \
+                if (im != NULL) {                                                 \
+                    im[i*cols+j] = parts == 2 ? (double) p[parts*(j*rows+i)+1] : 0; \
+                }                                                                 \
+            }                                                                     \
+        }                                                                         \
+    } else {                                                                      \
+        for (i=0; i<rows; ++i) {                                                  \
+            for (j=0; j<cols; ++j) {                                              \
+                const ctype *p = (const ctype *) (data + i*s0 + j*s1);            \
+                re[i*cols+j] = (double) p[0];                                     \
+                if (im != NULL) { im[i*cols+j] = parts == 2 ? (double) p[1] : 0; } \
+            }                                                                     \
+        }                                                                         \
+    }                                                                             \
 }
 
-// Product of two numbers
-npy_complex128 complex_prod(npy_complex128 a, npy_complex128 b) {
-    npy_complex128 x;
-    x.real = a.real*b.real - a.imag*b.imag;
-    x.imag = a.imag*b.real + a.real*b.imag;
-    return x;
-}
-
-// Product of complex and float
-npy_complex128 complex_float_prod(npy_complex128 a, float b) {
-    npy_complex128 x;
-    x.real = a.real*b;
-    x.imag = a.imag*b;
-    return x;
-}
+DEFINE_MATRIX_READER(read_float64, npy_float64, 1)
+DEFINE_MATRIX_READER(read_float32, npy_float32, 1)
+DEFINE_MATRIX_READER(read_complex128, npy_float64, 2)
+DEFINE_MATRIX_READER(read_complex64, npy_float32, 2)
 
-// Increment a number
-void complex_inc(npy_complex128 *a, npy_complex128 b) {
-    a->real = a->real + b.real;
-    a->imag = a->imag + b.imag;
+// Whether the matrix has a dtype the kernels accept
+static int check_matrix_dtype(PyArrayObject *a) {
+    if (!PyArray_ISNUMBER(a) && !PyArray_ISBOOL(a)) {
+        PyErr_SetString(PyExc_TypeError, "Array dtype must be real or complex.");
+        return -1;
+    }
+    return 0;
 }
 
-// Multipy a number by another one
-void complex_multiply(npy_complex128 *a, npy_complex128 b) {
-    double c = a->real;
-    a->real  = a->real*b.real-a->imag*b.imag;
-    a->imag  = c*b.imag+a->imag*b.real;
+// Reads a 2D array into real and imaginary buffers. If im is NULL only the
+// real part is read, otherwise real arrays get a zero imaginary part.
+// Other dtypes, misaligned arrays and arrays in non native byte order are
+// cast to float64/complex128 first.
+static int read_matrix(PyArrayObject *a, double *re, double *im) {
+    PyArrayObject *cast;
+    int type = PyArray_TYPE(a);
+    if (PyArray_ISBEHAVED_RO(a)) {
+        switch (type) {
+            case NPY_FLOAT64:    read_float64(a, re, im); return 0;
+            case NPY_FLOAT32:    read_float32(a, re, im); return 0;
+            case NPY_COMPLEX128: read_complex128(a, re, im); return 0;
+            case NPY_COMPLEX64:  read_complex64(a, re, im); return 0;
+        }
+    }
+    cast = (PyArrayObject *) PyArray_FROM_OTF((PyObject *) a,
+        PyArray_ISCOMPLEX(a) ? NPY_COMPLEX128 : NPY_FLOAT64, NPY_ARRAY_ALIGNED | NPY_ARRAY_NOTSWAPPED);
+    if (cast == NULL) { return -1; }
+    if (PyArray_ISCOMPLEX(cast)) { read_complex128(cast, re, im); }
+    else { read_float64(cast, re, im); }
+    Py_DECREF(cast);
+    return 0;
 }
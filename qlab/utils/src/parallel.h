@@ -0,0 +1,77 @@
+// Minimal native threads, used to split the permanent sums across cores.
+#include <stdlib.h>
+
+#ifdef _WIN32
+#include <windows.h>
+#include <process.h>
+typedef HANDLE parallel_thread;
+#else
+#include <pthread.h>
+typedef pthread_t parallel_thread;
+#endif
+
+typedef void (*parallel_fn)(void *arg);
+
+struct parallel_task {
+    parallel_fn fn;
+    void *arg;
+};
+
+#ifdef _WIN32
+static unsigned __stdcall parallel_entry(void *p) {
+    struct parallel_task *task = (struct parallel_task *) p;
+    task->fn(task->arg);
+    return 0;
+}
+#else
+static void *parallel_entry(void *p) {
+    struct parallel_task *task = (struct parallel_task *) p;
+    task->fn(task->arg);
+    return NULL;
+}
+#endif
+
+// Calls fn on the count jobs stored in args, each one size bytes long.
+// Job 0 runs on the calling thread, the others on new native threads.
+// If a thread cannot be started its job runs on the calling thread instead.
+// It must be called without holding the GIL if fn is slow.
+static void parallel_run(parallel_fn fn, void *args, size_t size, int count) {
+    struct parallel_task *tasks;
+    parallel_thread *threads;
+    char *started;
+    int i;
+
+    tasks = malloc(count * (sizeof(struct parallel_task) + sizeof(parallel_thread) + 1));
+    if (count <= 1 || tasks == NULL) {
+        free(tasks);
+        for (i=0; i<count; ++i) { fn((char *) args + i*size); }
+        return;
+    }
+    threads = (parallel_thread *) (tasks + count);
+    started = (char *) (threads + count);
+
+    for (i=1; i<count; ++i) {
+        tasks[i].fn = fn;
+        tasks[i].arg = (char *) args + i*size;
+#ifdef _WIN32
+        threads[i] = (HANDLE) _beginthreadex(NULL, 0, parallel_entry, &tasks[i], 0, NULL);
+        started[i] = threads[i] != 0;
+#else
+        started[i] = pthread_create(&threads[i], NULL, parallel_entry, &tasks[i]) == 0;
+#endif
+    }
+    fn(args);
+    for (i=1; i<count; ++i) {
+        if (started[i]) {
+#ifdef _WIN32
+            WaitForSingleObject(threads[i], INFINITE);
+            CloseHandle(threads[i]);
+#else
+            pthread_join(threads[i], NULL);
+#endif
+        } else {
+            fn(tasks[i].arg);
+        }
+    }
+    free(tasks);
+}
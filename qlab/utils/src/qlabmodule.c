@@ -2,14 +2,38 @@
 
 #include <Python.h>
 #include <numpy/arrayobject.h>
+#include <math.h>
+#include <stdlib.h>
+#include <limits.h>
 #include "npy_util.h"
 #include "bithacks.h"
+#include "parallel.h"
 
-static PyObject *qlab_utils_permanent(PyObject *self, PyObject *args);
+static PyObject *qlab_utils_permanent(PyObject *self, PyObject *args, PyObject *kwargs);
+static PyObject *qlab_utils_permanents(PyObject *self, PyObject *args, PyObject *kwargs);
+static PyObject *qlab_utils_permanent_minors(PyObject *self, PyObject *args, PyObject *kwargs);
 
 static PyMethodDef qlab_utils_methods[] = {
-    {"permanent", qlab_utils_permanent, METH_VARARGS,
-    "Evaluates the permanent of a complex matrix"},
+    {"permanent", (PyCFunction) qlab_utils_permanent, METH_VARARGS | METH_KEYWORDS,
+    "permanent(M, *, row_mult=None, col_mult=None, threads=1)\n\n"
+    "Evaluates the permanent of a real or complex matrix.\n"
+    "row_mult and col_mult give how many times each row and column of M is\n"
+    "repeated (bunched photons): the cost scales with the product of the\n"
+    "multiplicities plus one instead of with 2^n.\n"
+    "With threads > 1 the sum is split over that many native threads.\n"
+    "The GIL is released during the evaluation."},
+    {"permanents", (PyCFunction) qlab_utils_permanents, METH_VARARGS | METH_KEYWORDS,
+    "permanents(U, rows, cols, *, threads=1)\n\n"
+    "Evaluates the permanents of many submatrices of the matrix U.\n"
+    "rows and cols are (N, n) integer arrays: the i-th permanent is the one\n"
+    "of U[rows[i]][:, cols[i]]. Returns an (N,) array, complex if U is.\n"
+    "With threads > 1 the batch is split over that many native threads."},
+    {"permanent_minors", (PyCFunction) qlab_utils_permanent_minors, METH_VARARGS | METH_KEYWORDS,
+    "permanent_minors(M, *, threads=1)\n\n"
+    "Evaluates the permanents of all the (n-1) x (n-1) minors of a real or complex\n"
+    "n x n matrix. Element [i, j] of the result is the permanent of M without\n"
+    "row i and column j. They all come from a single Gray code walk, at the\n"
+    "cost of a few permanents of M."},
     {NULL,NULL,0,NULL}
 };
 
@@ -26,41 +50,879 @@ PyMODINIT_FUNC PyInit_permanent(void) {
     return PyModule_Create(&qlab_utils_module);
 }
 
-// Ryser's algorithm
-static npy_complex128 ryser(PyArrayObject *submatrix) {
-    int n = (int) PyArray_DIM(submatrix, 0);
-    npy_complex128 rowsum, rowsumprod;
-    npy_complex128 perm = complex_zero;
-    int exp = 1 << n;
-    int i, y, z;
-    for (i=0; i<exp; ++i) {
-        rowsumprod = complex_one;
-        for (y=0; y<n; ++y) {
-            rowsum = complex_zero;
-            for (z=0; z<n; ++z) {
-                if ((i & (1 << z)) != 0) {
-                  complex_inc(&rowsum, *SM(z, y));
-                }
+// Glynn's formula
+//   perm(A) = 2^(1-n) sum_d (prod_k d_k) prod_j (sum_i d_i a_ij)
+// with d_0 = +1 and d_1..d_(n-1) = +-1 visited in Gray code order, so that
+// going from one term to the next changes a single d_i and the column sums
+// are updated with one row of the matrix: O(2^(n-1) n) instead of O(2^n n^2).
+// A job sums the terms first <= k < last of the walk, so that the 2^(n-1)
+// terms can be split in independent chunks. The matrix is given as row major
+// real and imaginary parts; a NULL imaginary part selects the real kernel.
+static void glynn_real_sum(const double *a, int n, uint64_t first, uint64_t last,
+                           double *scratch, double *sum) {
+    double *s = scratch;
+    double p, acc = 0;
+    uint64_t k, g = gray_code(first);
+    int i, j, sign = popcount(g) & 1 ? -1 : 1;
+
+    for (j=0; j<n; ++j) { s[j] = 0; }
+    for (i=0; i<n; ++i) {
+        double d = (i > 0 && (g >> (i-1)) & 1) ? -1 : 1;
+        for (j=0; j<n; ++j) { s[j] += d * a[i*n+j]; }
+    }
+
+    for (k=first; k<last; ++k) {
+        if (k > first) {
+            int bit = lowest_bit(k);
+            const double *row = a + (bit+1)*n;
+            double f = (gray_code(k) >> bit) & 1 ? -2 : 2;
+            for (j=0; j<n; ++j) { s[j] += f * row[j]; }
+            sign = -sign;
+        }
+        p = 1;
+        for (j=0; j<n; ++j) { p *= s[j]; }
+        acc += sign > 0 ? p : -p;
+    }
+    *sum = acc;
+}
+
+static void glynn_sum(const double *re, const double *im, int n,
+                      uint64_t first, uint64_t last, double *scratch,
+                      double *sum_re, double *sum_im) {
+    double *s_re = scratch, *s_im = scratch + n;
+    double p_re, p_im, q_re, q_im, t, acc_re = 0, acc_im = 0;
+    uint64_t k, g = gray_code(first);
+    int i, j, sign = popcount(g) & 1 ? -1 : 1;
+
+    if (im == NULL) {
+        glynn_real_sum(re, n, first, last, scratch, sum_re);
+        *sum_im = 0;
+        return;
+    }
+
+    // Column sums for the signs of the first term
+    for (j=0; j<n; ++j) { s_re[j] = 0; s_im[j] = 0; }
+    for (i=0; i<n; ++i) {
+        double d = (i > 0 && (g >> (i-1)) & 1) ? -1 : 1;
+        for (j=0; j<n; ++j) {
+            s_re[j] += d * re[i*n+j];
+            s_im[j] += d * im[i*n+j];
+        }
+    }
+
+    for (k=first; k<last; ++k) {
+        if (k > first) {
+            // Flip the sign of row i, the one whose Gray code bit changed
+            int bit = lowest_bit(k);
+            const double *row_re = re + (bit+1)*n, *row_im = im + (bit+1)*n;
+            double f = (gray_code(k) >> bit) & 1 ? -2 : 2;
+            for (j=0; j<n; ++j) {
+                s_re[j] += f * row_re[j];
+                s_im[j] += f * row_im[j];
             }
-            complex_multiply(&rowsumprod, rowsum);
+            sign = -sign;
+        }
+
+        // Two independent chains of products, to keep the FPU busy
+        p_re = s_re[0]; p_im = s_im[0];
+        q_re = 1; q_im = 0;
+        for (j=1; j+1<n; j+=2) {
+            t    = p_re*s_re[j] - p_im*s_im[j];
+            p_im = p_re*s_im[j] + p_im*s_re[j];
+            p_re = t;
+            t    = q_re*s_re[j+1] - q_im*s_im[j+1];
+            q_im = q_re*s_im[j+1] + q_im*s_re[j+1];
+            q_re = t;
+        }
+        if (j < n) {
+            t    = p_re*s_re[j] - p_im*s_im[j];
+            p_im = p_re*s_im[j] + p_im*s_re[j];
+            p_re = t;
+        }
+        t    = p_re*q_re - p_im*q_im;
+        p_im = p_re*q_im + p_im*q_re;
+        p_re = t;
+        if (sign > 0) { acc_re += p_re; acc_im += p_im; }
+        else          { acc_re -= p_re; acc_im -= p_im; }
+    }
+    *sum_re = acc_re;
+    *sum_im = acc_im;
+}
+
+struct glynn_job {
+    const double *re, *im;
+    int n;
+    uint64_t first, last;
+    double sum_re, sum_im;
+    int status;
+};
+
+static void glynn_range(void *arg) {
+    struct glynn_job *job = (struct glynn_job *) arg;
+    double *scratch = malloc(2 * job->n * sizeof(double));
+    if (scratch == NULL) { job->status = -1; return; }
+    glynn_sum(job->re, job->im, job->n, job->first, job->last, scratch,
+              &job->sum_re, &job->sum_im);
+    free(scratch);
+    job->status = 0;
+}
+
+// Below this many terms per thread, starting threads costs more than it saves
+#define MIN_TERMS_PER_THREAD 4096
+
+// Splits the Glynn sum in chunks over at most `threads` native threads.
+// It does not touch Python objects, so it can run without the GIL.
+// With a NULL imaginary part the matrix is real and so is the result.
+static int glynn(const double *re, const double *im, int n, int threads,
+                 double *perm_re, double *perm_im) {
+    struct glynn_job *jobs;
+    uint64_t steps, chunk;
+    double sum_re = 0, sum_im = 0;
+    int c, status = 0;
+
+    *perm_im = 0;
+    if (n == 0) { *perm_re = 1; return 0; }
+
+    steps = (uint64_t) 1 << (n-1);
+    if ((uint64_t) threads > steps / MIN_TERMS_PER_THREAD) {
+        threads = (int) (steps / MIN_TERMS_PER_THREAD);
+    }
+    if (threads < 1) { threads = 1; }
+
+    jobs = malloc(threads * sizeof(struct glynn_job));
+    if (jobs == NULL) { return -1; }
+    chunk = steps / threads;
+    for (c=0; c<threads; ++c) {
+        jobs[c].re = re;
+        jobs[c].im = im;
+        jobs[c].n = n;
+        jobs[c].first = c * chunk;
+        jobs[c].last = c == threads-1 ? steps : (c+1) * chunk;
+    }
+    parallel_run(glynn_range, jobs, sizeof(struct glynn_job), threads);
+
+    // Reduce the partial sums
+    for (c=0; c<threads; ++c) {
+        if (jobs[c].status < 0) { status = -1; }
+        sum_re += jobs[c].sum_re;
+        sum_im += jobs[c].sum_im;
+    }
+    free(jobs);
+    *perm_re = ldexp(sum_re, 1-n);
+    if (im != NULL) { *perm_im = ldexp(sum_im, 1-n); }
+    return status;
+}
+
+// A Python float for real input, complex otherwise
+static PyObject *scalar_result(PyArrayObject *input, double re, double im) {
+    if (PyArray_ISCOMPLEX(input)) { return PyComplex_FromDoubles(re, im); }
+    return PyFloat_FromDouble(re);
+}
+
+// Glynn's formula for a matrix whose row i is repeated r_i times and whose
+// column j is repeated c_j times (sum_i r_i = sum_j c_j = n), grouping the
+// signs of the copies of each column:
+//   perm = 2^-n sum_x (-1)^(sum_j x_j) prod_j C(c_j, x_j) prod_i (sum_j (c_j - 2 x_j) a_ij)^r_i
+// with 0 <= x_j <= c_j. There are prod_j (c_j + 1) terms instead of 2^n.
+// The centred digits c_j - 2 x_j keep the row sums small, where Ryser's
+// x_j make terms much larger than the permanent cancel on bunched inputs.
+// x and c - x give the same term, so the x are visited in reflected mixed
+// radix Gray code order with the digit `split` at most c_split / 2, each term
+// changing one x_j by one so that the row sums are updated with one column.
+// A job fixes the digit `split` to the values first <= x < last, so that the
+// sum can be split in independent chunks.
+struct mult_job {
+    const double *re, *im;
+    int k, l;
+    const int *rmult, *cmult;
+    const double *binom;
+    int binom_size;
+    int split, first, last;
+    double sum_re, sum_im;
+    int status;
+};
+
+// z^e for a non negative integer e, by repeated squaring
+static void complex_ipow(double re, double im, int e, double *out_re, double *out_im) {
+    double r_re = 1, r_im = 0, t;
+    while (e > 0) {
+        if (e & 1) {
+            t    = r_re*re - r_im*im;
+            r_im = r_re*im + r_im*re;
+            r_re = t;
         }
-        complex_inc(&perm, complex_float_prod(rowsumprod, bitparity(i)));
+        t  = re*re - im*im;
+        im = 2*re*im;
+        re = t;
+        e >>= 1;
     }
-    if (n%2 == 1) { perm=complex_float_prod(perm, -1); }
-    return perm;
+    *out_re = r_re;
+    *out_im = r_im;
+}
+
+static void mult_range(void *arg) {
+    struct mult_job *job = (struct mult_job *) arg;
+    int k = job->k, l = job->l;
+    const double *re = job->re, *im = job->im;
+    double *s_re, *s_im, acc_re = 0, acc_im = 0;
+    int *x, *dir;
+    int i, j, v, parity;
+
+    s_re = malloc(2 * k * sizeof(double));
+    x = malloc(2 * l * sizeof(int));
+    if (s_re == NULL || x == NULL) {
+        free(s_re);
+        free(x);
+        job->status = -1;
+        return;
+    }
+    s_im = s_re + k;
+    dir = x + l;
+
+    for (v=job->first; v<job->last; ++v) {
+        // x and c - x are both counted, except in the middle
+        double symmetry = 2 * v == job->cmult[job->split] ? 1 : 2;
+        for (j=0; j<l; ++j) { x[j] = 0; dir[j] = 1; }
+        x[job->split] = v;
+        parity = v & 1;
+        for (i=0; i<k; ++i) {
+            s_re[i] = s_im[i] = 0;
+            for (j=0; j<l; ++j) {
+                s_re[i] += (job->cmult[j] - 2*x[j]) * re[i*l+j];
+                s_im[i] += (job->cmult[j] - 2*x[j]) * im[i*l+j];
+            }
+        }
+
+        while (1) {
+            double w = symmetry, p_re = 1, p_im = 0, f_re, f_im, t;
+            for (j=0; j<l; ++j) { w *= job->binom[job->cmult[j]*job->binom_size + x[j]]; }
+            for (i=0; i<k; ++i) {
+                complex_ipow(s_re[i], s_im[i], job->rmult[i], &f_re, &f_im);
+                t    = p_re*f_re - p_im*f_im;
+                p_im = p_re*f_im + p_im*f_re;
+                p_re = t;
+            }
+            if (parity) { w = -w; }
+            acc_re += w * p_re;
+            acc_im += w * p_im;
+
+            // Move the lowest digit that can still go in its direction,
+            // reversing the ones below it
+            for (j=0; j<l; ++j) {
+                if (j == job->split) { continue; }
+                if (x[j] + dir[j] >= 0 && x[j] + dir[j] <= job->cmult[j]) { break; }
+                dir[j] = -dir[j];
+            }
+            if (j == l) { break; }
+            x[j] += dir[j];
+            parity ^= 1;
+            for (i=0; i<k; ++i) {
+                s_re[i] -= 2 * dir[j] * re[i*l+j];
+                s_im[i] -= 2 * dir[j] * im[i*l+j];
+            }
+        }
+    }
+
+    free(s_re);
+    free(x);
+    job->sum_re = acc_re;
+    job->sum_im = acc_im;
+    job->status = 0;
+}
+
+// Reads a vector of multiplicities, defaulting to ones when obj is None
+static int *read_multiplicities(PyObject *obj, npy_intp length, const char *name) {
+    PyArrayObject *array;
+    const npy_intp *data;
+    npy_intp i;
+    int *mult = malloc((length + 1) * sizeof(int));
+    if (mult == NULL) {
+        PyErr_NoMemory();
+        return NULL;
+    }
+    if (obj == Py_None) {
+        for (i=0; i<length; ++i) { mult[i] = 1; }
+        return mult;
+    }
+    array = (PyArrayObject *) PyArray_FROM_OTF(obj, NPY_INTP, NPY_ARRAY_IN_ARRAY);
+    if (array == NULL) {
+        free(mult);
+        return NULL;
+    }
+    if (PyArray_NDIM(array) != 1 || PyArray_DIM(array, 0) != length) {
+        PyErr_Format(PyExc_ValueError, "`%s` must have one entry per %s of the matrix.",
+                     name, name[0] == 'r' ? "row" : "column");
+        goto fail;
+    }
+    data = (const npy_intp *) PyArray_DATA(array);
+    for (i=0; i<length; ++i) {
+        if (data[i] < 0 || data[i] > INT_MAX / 2) {
+            PyErr_Format(PyExc_ValueError, "`%s` entries must be non negative integers.", name);
+            goto fail;
+        }
+        mult[i] = (int) data[i];
+    }
+    Py_DECREF(array);
+    return mult;
+
+fail:
+    Py_DECREF(array);
+    free(mult);
+    return NULL;
+}
+
+// Permanent of the matrix with repeated rows and columns. It sums Glynn's
+// formula over the multiplicities of the side with fewer terms, or over the
+// signs of the expanded matrix when that is cheaper.
+static PyObject *permanent_multiplicities(PyArrayObject *input, PyObject *row_obj,
+                                          PyObject *col_obj, int threads) {
+  PyObject *result = NULL;
+  struct mult_job *jobs = NULL;
+  double *buffer = NULL, *re, *im, *binom = NULL, row_terms = 1, col_terms = 1;
+  double p_re = 0, p_im = 0;
+  int *rmult = NULL, *cmult = NULL, *tmp;
+  int rows, cols, k, l, i, j, ii, jj, n = 0, m = 0, maxc = 0, split, c, status = 0;
+
+  if (PyArray_NDIM(input) != 2) {
+      PyErr_SetString(PyExc_ValueError, "Array must be a matrix.");
+      return NULL;
+  }
+  rows = (int) PyArray_DIM(input, 0);
+  cols = (int) PyArray_DIM(input, 1);
+  rmult = read_multiplicities(row_obj, rows, "row_mult");
+  if (rmult == NULL) {goto done;}
+  cmult = read_multiplicities(col_obj, cols, "col_mult");
+  if (cmult == NULL) {goto done;}
+  for (i=0; i<rows; ++i) { n += rmult[i]; row_terms *= rmult[i] + 1; }
+  for (j=0; j<cols; ++j) { m += cmult[j]; col_terms *= cmult[j] + 1; }
+  if (n != m) {
+      PyErr_SetString(PyExc_ValueError, "`row_mult` and `col_mult` must add up to the same number.");
+      goto done;
+  }
+
+  buffer = malloc((4 * (npy_intp) rows * cols + 1) * sizeof(double));
+  if (buffer == NULL) {
+      PyErr_NoMemory();
+      goto done;
+  }
+  if (read_matrix(input, buffer + 2*rows*cols, buffer + 3*rows*cols) < 0) {goto done;}
+
+  // Drop the rows and columns that do not appear, and iterate over the
+  // columns of whichever orientation has fewer terms
+  re = buffer;
+  im = buffer + rows*cols;
+  k = 0;
+  l = 0;
+  for (i=0; i<rows; ++i) { k += rmult[i] != 0; }
+  for (j=0; j<cols; ++j) { l += cmult[j] != 0; }
+  for (i=0, ii=0; i<rows; ++i) {
+      if (rmult[i] == 0) { continue; }
+      for (j=0, jj=0; j<cols; ++j) {
+          if (cmult[j] == 0) { continue; }
+          if (row_terms < col_terms) {
+              re[jj*k+ii] = buffer[2*rows*cols + i*cols+j];
+              im[jj*k+ii] = buffer[3*rows*cols + i*cols+j];
+          } else {
+              re[ii*l+jj] = buffer[2*rows*cols + i*cols+j];
+              im[ii*l+jj] = buffer[3*rows*cols + i*cols+j];
+          }
+          ++jj;
+      }
+      rmult[ii++] = rmult[i];
+  }
+  for (j=0, jj=0; j<cols; ++j) {
+      if (cmult[j] != 0) { cmult[jj++] = cmult[j]; }
+  }
+  if (row_terms < col_terms) {
+      c = k; k = l; l = c;
+      tmp = rmult; rmult = cmult; cmult = tmp;
+      col_terms = row_terms;
+  }
+
+  if (n == 0) {
+      result = scalar_result(input, 1, 0);
+      goto done;
+  }
+
+  if (n <= 64 && col_terms / 2 * (k + l) >= ldexp(n, n-1)) {
+      // Glynn on the expanded n x n matrix is cheaper
+      double *expanded = malloc(2 * n * n * sizeof(double));
+      int r, q, ei = 0, ej;
+      if (expanded == NULL) {
+          PyErr_NoMemory();
+          goto done;
+      }
+      for (i=0; i<k; ++i) {
+          for (r=0; r<rmult[i]; ++r, ++ei) {
+              ej = 0;
+              for (j=0; j<l; ++j) {
+                  for (q=0; q<cmult[j]; ++q, ++ej) {
+                      expanded[ei*n+ej] = re[i*l+j];
+                      expanded[n*n + ei*n+ej] = im[i*l+j];
+                  }
+              }
+          }
+      }
+      Py_BEGIN_ALLOW_THREADS
+      status = glynn(expanded, PyArray_ISCOMPLEX(input) ? expanded + n*n : NULL,
+                     n, threads, &p_re, &p_im);
+      Py_END_ALLOW_THREADS
+      free(expanded);
+      if (status < 0) {PyErr_NoMemory();}
+      else {result = scalar_result(input, p_re, p_im);}
+      goto done;
+  }
+  if (col_terms > 9.2e18) {
+      PyErr_SetString(PyExc_ValueError, "Too many terms in the permanent.");
+      goto done;
+  }
+
+  // Binomial coefficients, and the digit with most values to split on
+  split = 0;
+  for (j=0; j<l; ++j) {
+      if (cmult[j] > maxc) { maxc = cmult[j]; split = j; }
+  }
+  binom = malloc((maxc + 1) * (maxc + 1) * sizeof(double));
+  if (binom == NULL) {
+      PyErr_NoMemory();
+      goto done;
+  }
+  for (i=0; i<=maxc; ++i) {
+      for (j=0; j<=maxc; ++j) {
+          binom[i*(maxc+1)+j] = j == 0 ? 1 : (i == 0 ? 0 :
+              binom[(i-1)*(maxc+1)+j-1] + (j < i ? binom[(i-1)*(maxc+1)+j] : 0));
+      }
+  }
+
+  if (threads > maxc / 2 + 1) { threads = maxc / 2 + 1; }
+  if (col_terms < MIN_TERMS_PER_THREAD) { threads = 1; }
+  jobs = malloc(threads * sizeof(struct mult_job));
+  if (jobs == NULL) {
+      PyErr_NoMemory();
+      goto done;
+  }
+  for (c=0; c<threads; ++c) {
+      jobs[c].re = re;
+      jobs[c].im = im;
+      jobs[c].k = k;
+      jobs[c].l = l;
+      jobs[c].rmult = rmult;
+      jobs[c].cmult = cmult;
+      jobs[c].binom = binom;
+      jobs[c].binom_size = maxc + 1;
+      jobs[c].split = split;
+      jobs[c].first = c * (maxc / 2 + 1) / threads;
+      jobs[c].last = (c + 1) * (maxc / 2 + 1) / threads;
+  }
+  Py_BEGIN_ALLOW_THREADS
+  parallel_run(mult_range, jobs, sizeof(struct mult_job), threads);
+  Py_END_ALLOW_THREADS
+  for (c=0; c<threads; ++c) {
+      if (jobs[c].status < 0) { status = -1; }
+      p_re += jobs[c].sum_re;
+      p_im += jobs[c].sum_im;
+  }
+  if (status < 0) {
+      PyErr_NoMemory();
+      goto done;
+  }
+  result = scalar_result(input, ldexp(p_re, -n), ldexp(p_im, -n));
+
+done:
+  free(jobs);
+  free(binom);
+  free(buffer);
+  free(rmult);
+  free(cmult);
+  return result;
 }
 
 // This is a wrapper which chooses the optimal permanent function
-static PyObject *qlab_utils_permanent(PyObject *self, PyObject *args) {
+static PyObject *qlab_utils_permanent(PyObject *self, PyObject *args, PyObject *kwargs) {
   // Parse the input
-  PyArrayObject *submatrix;
-  if (!PyArg_ParseTuple(args, "O!", &PyArray_Type, &submatrix)) {return NULL;}
-  if (!PyArray_ISCOMPLEX(submatrix)) {
-      PyErr_SetString(PyExc_TypeError, "Array dtype must be `complex`.");
+  static char *kwlist[] = {"M", "row_mult", "col_mult", "threads", NULL};
+  PyArrayObject *input;
+  PyObject *row_obj = Py_None, *col_obj = Py_None;
+  double *buffer, *im, p_re, p_im;
+  int n, status, threads = 1;
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O!|$OOi", kwlist,
+                                   &PyArray_Type, &input, &row_obj, &col_obj, &threads)) {return NULL;}
+  if (threads < 1) {
+      PyErr_SetString(PyExc_ValueError, "`threads` must be at least 1.");
+      return NULL;
+  }
+  if (check_matrix_dtype(input) < 0) {return NULL;}
+  if (row_obj != Py_None || col_obj != Py_None) {
+      return permanent_multiplicities(input, row_obj, col_obj, threads);
+  }
+  if (PyArray_NDIM(input) != 2 || PyArray_DIM(input, 0) != PyArray_DIM(input, 1)) {
+      PyErr_SetString(PyExc_ValueError, "Array must be a square matrix.");
+      return NULL;
+  }
+  if (PyArray_DIM(input, 0) > 64) {
+      PyErr_SetString(PyExc_ValueError, "Matrices larger than 64x64 are not supported.");
+      return NULL;
+  }
+
+  // Read the elements, whatever the dtype and the strides are
+  n = (int) PyArray_DIM(input, 0);
+  buffer = malloc((2 * n * n + 1) * sizeof(double));
+  if (buffer == NULL) {return PyErr_NoMemory();}
+  im = PyArray_ISCOMPLEX(input) ? buffer + n*n : NULL;
+  if (read_matrix(input, buffer, im) < 0) {
+      free(buffer);
+      return NULL;
+  }
+
+  // Compute the permanent, letting other Python threads run meanwhile
+  Py_BEGIN_ALLOW_THREADS
+  status = glynn(buffer, im, n, threads, &p_re, &p_im);
+  Py_END_ALLOW_THREADS
+  free(buffer);
+  if (status < 0) {return PyErr_NoMemory();}
+  return scalar_result(input, p_re, p_im);
+}
+
+// A slice of a batch of submatrices of one matrix, evaluated by one thread
+// with a single set of scratch buffers.
+struct batch_job {
+    const double *re, *im;
+    npy_intp cols_number;
+    const npy_intp *rows, *cols;
+    int n;
+    npy_intp first, last;
+    double *out;
+    int status;
+};
+
+static void batch_range(void *arg) {
+    struct batch_job *job = (struct batch_job *) arg;
+    int n = job->n;
+    npy_intp b;
+    int i, j;
+    double *sub_re, *sub_im, *scratch;
+
+    sub_re = malloc((2 * n * n + 2 * n + 1) * sizeof(double));
+    if (sub_re == NULL) { job->status = -1; return; }
+    sub_im = job->im == NULL ? NULL : sub_re + n*n;
+    scratch = sub_re + 2*n*n;
+
+    for (b=job->first; b<job->last; ++b) {
+        const npy_intp *r = job->rows + b*n, *c = job->cols + b*n;
+        double sum_re = 1, sum_im = 0;
+        if (n > 0) {
+            // Gather the submatrix
+            for (i=0; i<n; ++i) {
+                for (j=0; j<n; ++j) {
+                    sub_re[i*n+j] = job->re[r[i]*job->cols_number + c[j]];
+                    if (sub_im != NULL) {
+                        sub_im[i*n+j] = job->im[r[i]*job->cols_number + c[j]];
+                    }
+                }
+            }
+            glynn_sum(sub_re, sub_im, n, 0, (uint64_t) 1 << (n-1), scratch, &sum_re, &sum_im);
+            sum_re = ldexp(sum_re, 1-n);
+            sum_im = ldexp(sum_im, 1-n);
+        }
+        if (sub_im != NULL || job->im != NULL) {
+            job->out[2*b] = sum_re;
+            job->out[2*b+1] = sum_im;
+        } else {
+            job->out[b] = sum_re;
+        }
+    }
+    free(sub_re);
+    job->status = 0;
+}
+
+// Checks that an index array has shape (N, n) and entries in [0, size)
+static int check_indices(PyArrayObject *indices, const char *name, npy_intp size) {
+    npy_intp k, count = PyArray_SIZE(indices);
+    const npy_intp *data = (const npy_intp *) PyArray_DATA(indices);
+    if (PyArray_NDIM(indices) != 2) {
+        PyErr_Format(PyExc_ValueError, "`%s` must be a 2D array.", name);
+        return -1;
+    }
+    for (k=0; k<count; ++k) {
+        if (data[k] < 0 || data[k] >= size) {
+            PyErr_Format(PyExc_IndexError, "`%s` contains an out of bounds index.", name);
+            return -1;
+        }
+    }
+    return 0;
+}
+
+// Batched permanents of submatrices of the same matrix
+static PyObject *qlab_utils_permanents(PyObject *self, PyObject *args, PyObject *kwargs) {
+  static char *kwlist[] = {"U", "rows", "cols", "threads", NULL};
+  PyArrayObject *input, *rows = NULL, *cols = NULL, *result = NULL;
+  PyObject *rows_obj, *cols_obj;
+  struct batch_job *jobs;
+  double *buffer;
+  npy_intp batch, chunk, size, out_dims[1];
+  int n, c, is_complex, threads = 1, status = 0;
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O!OO|$i", kwlist,
+                                   &PyArray_Type, &input, &rows_obj, &cols_obj, &threads)) {return NULL;}
+  if (threads < 1) {
+      PyErr_SetString(PyExc_ValueError, "`threads` must be at least 1.");
+      return NULL;
+  }
+  if (check_matrix_dtype(input) < 0) {return NULL;}
+  if (PyArray_NDIM(input) != 2) {
+      PyErr_SetString(PyExc_ValueError, "Array must be a matrix.");
+      return NULL;
+  }
+
+  rows = (PyArrayObject *) PyArray_FROM_OTF(rows_obj, NPY_INTP, NPY_ARRAY_IN_ARRAY);
+  if (rows == NULL) {goto fail;}
+  cols = (PyArrayObject *) PyArray_FROM_OTF(cols_obj, NPY_INTP, NPY_ARRAY_IN_ARRAY);
+  if (cols == NULL) {goto fail;}
+  if (check_indices(rows, "rows", PyArray_DIM(input, 0)) < 0 ||
+      check_indices(cols, "cols", PyArray_DIM(input, 1)) < 0) {goto fail;}
+  if (PyArray_DIM(rows, 0) != PyArray_DIM(cols, 0) || PyArray_DIM(rows, 1) != PyArray_DIM(cols, 1)) {
+      PyErr_SetString(PyExc_ValueError, "`rows` and `cols` must have the same shape.");
+      goto fail;
+  }
+  if (PyArray_DIM(rows, 1) > 64) {
+      PyErr_SetString(PyExc_ValueError, "Matrices larger than 64x64 are not supported.");
+      goto fail;
+  }
+  batch = PyArray_DIM(rows, 0);
+  n = (int) PyArray_DIM(rows, 1);
+
+  out_dims[0] = batch;
+  size = PyArray_SIZE(input);
+  is_complex = PyArray_ISCOMPLEX(input);
+  result = (PyArrayObject *) PyArray_SimpleNew(1, out_dims, is_complex ? NPY_COMPLEX128 : NPY_FLOAT64);
+  if (result == NULL) {goto fail;}
+
+  // Read the whole matrix once, whatever the dtype and the strides are
+  buffer = malloc((2 * size + 1) * sizeof(double));
+  if (buffer == NULL) {
+      PyErr_NoMemory();
+      goto fail;
+  }
+  if (read_matrix(input, buffer, is_complex ? buffer + size : NULL) < 0) {
+      free(buffer);
+      goto fail;
+  }
+
+  if (threads > batch) { threads = batch > 0 ? (int) batch : 1; }
+  jobs = malloc(threads * sizeof(struct batch_job));
+  if (jobs == NULL) {
+      free(buffer);
+      PyErr_NoMemory();
+      goto fail;
+  }
+  chunk = batch / threads;
+  for (c=0; c<threads; ++c) {
+      jobs[c].re = buffer;
+      jobs[c].im = is_complex ? buffer + size : NULL;
+      jobs[c].cols_number = PyArray_DIM(input, 1);
+      jobs[c].rows = (const npy_intp *) PyArray_DATA(rows);
+      jobs[c].cols = (const npy_intp *) PyArray_DATA(cols);
+      jobs[c].n = n;
+      jobs[c].first = c * chunk;
+      jobs[c].last = c == threads-1 ? batch : (c+1) * chunk;
+      jobs[c].out = (double *) PyArray_DATA(result);
+  }
+
+  Py_BEGIN_ALLOW_THREADS
+  parallel_run(batch_range, jobs, sizeof(struct batch_job), threads);
+  Py_END_ALLOW_THREADS
+
+  for (c=0; c<threads; ++c) {
+      if (jobs[c].status < 0) { status = -1; }
+  }
+  free(jobs);
+  free(buffer);
+  Py_DECREF(rows);
+  Py_DECREF(cols);
+  if (status < 0) {
+      Py_DECREF(result);
+      return PyErr_NoMemory();
+  }
+  return (PyObject *) result;
+
+fail:
+  Py_XDECREF(rows);
+  Py_XDECREF(cols);
+  Py_XDECREF(result);
+  return NULL;
+}
+
+// All the minors from one walk of Glynn's formula. With d uniform in {-1,1}^n,
+//   perm(M without row i and column j) = E[(prod_(k != i) d_k) prod_(l != j) s_l]
+// where s_l = sum_k d_k a_kl, and d_0 = +1 can be fixed by symmetry. Writing
+// w = prod_k d_k and P_j = prod_(l != j) s_l, minor (i, j) is the sum of
+// d_i w P_j. The sums A_j of w P_j are accumulated at every term, and d_i
+// only changes when row i flips: at each flip the block of terms since the
+// previous flip of row i is added to row i of the minors with the old sign.
+// Every term costs O(n) and the minors O(n^2) once at the end.
+struct minors_job {
+    const double *re, *im;
+    int n;
+    uint64_t first, last;
+    double *out;
+    int status;
+};
+
+static void minors_range(void *arg) {
+    struct minors_job *job = (struct minors_job *) arg;
+    const double *re = job->re, *im = job->im;
+    int n = job->n;
+    double *s_re, *s_im, *pre_re, *pre_im, *a_re, *a_im, *c_re, *c_im, *out = job->out;
+    double *d;
+    double p_re, p_im, q_re, q_im, t;
+    uint64_t k, g = gray_code(job->first);
+    int i, j, sign = popcount(g) & 1 ? -1 : 1;
+
+    s_re = malloc((7 * n + 2 * n * n) * sizeof(double));
+    if (s_re == NULL) { job->status = -1; return; }
+    s_im = s_re + n;
+    pre_re = s_im + n;
+    pre_im = pre_re + n;
+    a_re = pre_im + n;
+    a_im = a_re + n;
+    d = a_im + n;
+    c_re = d + n;
+    c_im = c_re + n*n;
+
+    for (i=0; i<n; ++i) { d[i] = (i > 0 && (g >> (i-1)) & 1) ? -1 : 1; }
+    for (j=0; j<n; ++j) { s_re[j] = 0; s_im[j] = 0; a_re[j] = 0; a_im[j] = 0; }
+    for (i=0; i<n; ++i) {
+        for (j=0; j<n; ++j) {
+            s_re[j] += d[i] * re[i*n+j];
+            s_im[j] += d[i] * im[i*n+j];
+        }
+    }
+    for (j=0; j<2*n*n; ++j) { c_re[j] = 0; out[j] = 0; }
+
+    for (k=job->first; k<job->last; ++k) {
+        if (k > job->first) {
+            // Row i flips: close its block of terms with the old sign
+            int bit = lowest_bit(k), r = bit+1;
+            const double *row_re = re + r*n, *row_im = im + r*n;
+            double f = -2 * d[r];
+            for (j=0; j<n; ++j) {
+                out[2*(r*n+j)]   += d[r] * (a_re[j] - c_re[r*n+j]);
+                out[2*(r*n+j)+1] += d[r] * (a_im[j] - c_im[r*n+j]);
+                c_re[r*n+j] = a_re[j];
+                c_im[r*n+j] = a_im[j];
+                s_re[j] += f * row_re[j];
+                s_im[j] += f * row_im[j];
+            }
+            d[r] = -d[r];
+            sign = -sign;
+        }
+
+        // Products of all the column sums but one: prefix times suffix
+        p_re = sign; p_im = 0;
+        for (j=0; j<n; ++j) {
+            pre_re[j] = p_re; pre_im[j] = p_im;
+            t    = p_re*s_re[j] - p_im*s_im[j];
+            p_im = p_re*s_im[j] + p_im*s_re[j];
+            p_re = t;
+        }
+        q_re = 1; q_im = 0;
+        for (j=n-1; j>=0; --j) {
+            a_re[j] += pre_re[j]*q_re - pre_im[j]*q_im;
+            a_im[j] += pre_re[j]*q_im + pre_im[j]*q_re;
+            t    = q_re*s_re[j] - q_im*s_im[j];
+            q_im = q_re*s_im[j] + q_im*s_re[j];
+            q_re = t;
+        }
+    }
+
+    // Close the last block of every row
+    for (i=0; i<n; ++i) {
+        for (j=0; j<n; ++j) {
+            out[2*(i*n+j)]   += d[i] * (a_re[j] - c_re[i*n+j]);
+            out[2*(i*n+j)+1] += d[i] * (a_im[j] - c_im[i*n+j]);
+        }
+    }
+    free(s_re);
+    job->status = 0;
+}
+
+// Permanents of all the minors of a square matrix
+static PyObject *qlab_utils_permanent_minors(PyObject *self, PyObject *args, PyObject *kwargs) {
+  static char *kwlist[] = {"M", "threads", NULL};
+  PyArrayObject *input, *result;
+  struct minors_job *jobs;
+  double *buffer, *out;
+  npy_intp dims[2];
+  uint64_t steps, chunk;
+  int n, c, j, parts, threads = 1, status = 0;
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O!|$i", kwlist,
+                                   &PyArray_Type, &input, &threads)) {return NULL;}
+  if (threads < 1) {
+      PyErr_SetString(PyExc_ValueError, "`threads` must be at least 1.");
       return NULL;
   }
+  if (check_matrix_dtype(input) < 0) {return NULL;}
+  if (PyArray_NDIM(input) != 2 || PyArray_DIM(input, 0) != PyArray_DIM(input, 1)) {
+      PyErr_SetString(PyExc_ValueError, "Array must be a square matrix.");
+      return NULL;
+  }
+  if (PyArray_DIM(input, 0) > 64) {
+      PyErr_SetString(PyExc_ValueError, "Matrices larger than 64x64 are not supported.");
+      return NULL;
+  }
+
+  dims[0] = dims[1] = PyArray_DIM(input, 0);
+  parts = PyArray_ISCOMPLEX(input) ? 2 : 1;
+  result = (PyArrayObject *) PyArray_ZEROS(2, dims, parts == 2 ? NPY_COMPLEX128 : NPY_FLOAT64, 0);
+  if (result == NULL) {return NULL;}
+  n = (int) dims[0];
+  if (n == 0) {return (PyObject *) result;}
 
-  // Compute the permanent
-  npy_complex128 p = ryser(submatrix);
-  return PyComplex_FromDoubles(p.real, p.imag);
+  steps = (uint64_t) 1 << (n-1);
+  if ((uint64_t) threads > steps / MIN_TERMS_PER_THREAD) {
+      threads = (int) (steps / MIN_TERMS_PER_THREAD);
+  }
+  if (threads < 1) { threads = 1; }
+  buffer = malloc((2 * n * n * (threads + 1) + 1) * sizeof(double));
+  jobs = malloc(threads * sizeof(struct minors_job));
+  if (buffer == NULL || jobs == NULL) {
+      free(buffer);
+      free(jobs);
+      Py_DECREF(result);
+      return PyErr_NoMemory();
+  }
+  if (read_matrix(input, buffer, buffer + n*n) < 0) {
+      free(buffer);
+      free(jobs);
+      Py_DECREF(result);
+      return NULL;
+  }
+
+  chunk = steps / threads;
+  for (c=0; c<threads; ++c) {
+      jobs[c].re = buffer;
+      jobs[c].im = buffer + n*n;
+      jobs[c].n = n;
+      jobs[c].first = c * chunk;
+      jobs[c].last = c == threads-1 ? steps : (c+1) * chunk;
+      jobs[c].out = buffer + 2*n*n*(c+1);
+  }
+
+  Py_BEGIN_ALLOW_THREADS
+  parallel_run(minors_range, jobs, sizeof(struct minors_job), threads);
+  Py_END_ALLOW_THREADS
+
+  // Reduce the partial minors, keeping only the real parts for real input
+  out = (double *) PyArray_DATA(result);
+  for (c=0; c<threads; ++c) {
+      if (jobs[c].status < 0) { status = -1; }
+      for (j=0; j<2*n*n; j+=3-parts) { out[j/(3-parts)] += jobs[c].out[j]; }
+  }
+  for (j=0; j<parts*n*n; ++j) { out[j] = ldexp(out[j], 1-n); }
+  free(jobs);
+  free(buffer);
+  if (status < 0) {
+      Py_DECREF(result);
+      return PyErr_NoMemory();
+  }
+  return (PyObject *) result;
 }
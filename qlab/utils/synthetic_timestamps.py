@@ -0,0 +1,147 @@
+import numpy as np
+from .timestamps import TIMESTAMP_DTYPE
+from .hom_plot import HOM_func
+
+# Jitter is drawn within this many standard deviations, so that events can
+# be written in order segment by segment
+_JITTER_CUT = 6
+
+def synthetic_timestamps(file_name, duration, dark_rates=1e3, pair_rate=0.0, pairs=[(0, 1)],
+                         coincidence_probability=1.0, efficiency=1.0, jitter=0.0, delays=None,
+                         channels=8, timebase=81e-12, seed=None, chunk_size=1 << 22):
+    """Writes an ID800 timestamp file of random events.
+
+    Photon pairs are emitted at random times on every pair of channels of
+    ``pairs``. The two photons of a pair go to the two channels with
+    probability ``coincidence_probability``, else both to one of them at
+    random, where they make a single click. Each photon is detected with
+    probability ``efficiency``, at its time plus a gaussian jitter and the
+    delay of its channel. Uncorrelated events, such as dark counts, are
+    added on every channel.
+
+    Events are drawn and written in segments of about ``chunk_size``
+    events, so files larger than the memory can be generated.
+
+    Args:
+        file_name (str): The file to write, in the format of
+            :meth:`qlab.controllers.IDQ800.run_acquisition`.
+        duration (float): The acquisition time, in seconds.
+        dark_rates (float or array, optional): The rate of uncorrelated
+            events of each channel, in events per second.
+        pair_rate (float, optional): The rate of photon pairs of each pair of
+            channels, in pairs per second.
+        pairs (list, optional): The pairs of channels receiving the photons
+            of a pair, numbered from 0.
+        coincidence_probability (float, optional): The probability that the
+            photons of a pair go to different channels.
+        efficiency (float, optional): The detection efficiency.
+        jitter (float, optional): The standard deviation of the timing
+            jitter, in units of ``timebase``.
+        delays (array, optional): The delay of each channel, in units of
+            ``timebase``. Default: no delays.
+        channels (int, optional): The number of channels.
+        timebase (float, optional): The unit of the timestamps, in seconds.
+        seed (int, optional): The seed of the random events.
+        chunk_size (int, optional): The number of events drawn at once.
+
+    Returns:
+        int: The number of events written.
+
+    Examples:
+        Pairs at 10 kHz on the channels 0 and 1, with 500 ps of jitter
+
+        >>> synthetic_timestamps('timestamps1.bin', 10.0, pair_rate=1e4, jitter=6)
+    """
+    random = np.random.default_rng(seed)
+    dark_rates = np.broadcast_to(np.asarray(dark_rates, dtype=float), (channels,))
+    delays = np.zeros(channels, dtype=np.int64) if delays is None else \
+        np.broadcast_to(np.asarray(delays, dtype=np.int64), (channels,))
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    total_rate = dark_rates.sum() + 2 * pair_rate * len(pairs)
+    segment = max(int(chunk_size / max(total_rate, 1.0) / timebase), 1)
+    end = int(duration / timebase)
+    # No event of a later segment comes before its start plus this
+    earliest = int(delays.min() - np.ceil(_JITTER_CUT * jitter))
+    carry = np.empty(0, dtype=TIMESTAMP_DTYPE)
+    written = 0
+    with open(file_name, 'wb') as timestamps_file:
+        for start in range(0, end, segment):
+            stop = min(start + segment, end)
+            span = (stop - start) * timebase
+            times, chans = [], []
+            counts = random.poisson(dark_rates * span)
+            times.append(random.integers(start, stop, counts.sum()))
+            chans.append(np.repeat(np.arange(channels), counts))
+            for a, b in pairs:
+                emitted = random.integers(start, stop, random.poisson(pair_rate * span))
+                split = random.random(emitted.size) < coincidence_probability
+                # Split pairs: one photon on each channel
+                for channel in (a, b):
+                    detected = split & (random.random(emitted.size) < efficiency)
+                    times.append(emitted[detected])
+                    chans.append(np.full(np.count_nonzero(detected), channel))
+                # Bunched pairs: a single click, from either photon
+                bunched = ~split & (random.random(emitted.size) < 1 - (1 - efficiency) ** 2)
+                times.append(emitted[bunched])
+                chans.append(np.where(random.random(np.count_nonzero(bunched)) < 0.5, a, b))
+            events = np.empty(sum(t.size for t in times), dtype=TIMESTAMP_DTYPE)
+            events['channel'] = np.concatenate(chans)
+            events['timestamp'] = np.concatenate(times) + delays[events['channel']]
+            if jitter > 0:
+                events['timestamp'] += np.rint(np.clip(random.normal(0, jitter, events.size),
+                                                       -_JITTER_CUT * jitter, _JITTER_CUT * jitter)).astype(np.int64)
+            events = np.concatenate((carry, events))
+            events = events[np.argsort(events['timestamp'], kind='stable')]
+            cut = events.size if stop == end else \
+                np.searchsorted(events['timestamp'], stop + earliest, 'left')
+            events[:cut].tofile(timestamps_file)
+            written += cut
+            carry = events[cut:]
+    return written
+
+def synthetic_hom_scan(file_prefix, steps_number, duration, visibility=0.9, center=None,
+                       width=None, pair_rate=1e4, pairs=[(0, 1)], file_suffix=".bin",
+                       seed=None, **options):
+    """Writes the timestamp files of a simulated HOM scan, one per step.
+
+    At every step the photons of a pair go to different channels with the
+    probability ``HOM_func(step, 0.5, visibility, center, width)``, half
+    the time far from the dip, see :func:`qlab.utils.hom_plot.HOM_func`.
+
+    Args:
+        file_prefix (str): The files are named ``file_prefix``, the step on
+            3 digits and ``file_suffix``.
+        steps_number (int): The number of steps.
+        duration (float): The acquisition time of a step, in seconds.
+        visibility (float, optional): The visibility of the dip.
+        center (float, optional): The step of the dip, with the steps
+            numbered from 1 as in the fits of :func:`qlab.utils.hom_plot`.
+            Default: the middle of the scan.
+        width (float, optional): The full width at half maximum of the dip,
+            in steps. Default: a tenth of the scan.
+        pair_rate (float, optional): The rate of photon pairs of each pair
+            of channels.
+        pairs (list, optional): The pairs of channels of the photons.
+        file_suffix (str, optional): The end of the file names.
+        seed (int, optional): The seed of the random events.
+        **options: The other arguments of :func:`synthetic_timestamps`.
+
+    Returns:
+        list: The names of the files, in the order of the steps.
+
+    Examples:
+        >>> files = synthetic_hom_scan('step', 50, 1.0, jitter=6)
+        >>> coincidences_scan(files, 'scan.txt', 25, channels_number=8)
+        >>> results = analyze_hom('scan.txt', 50, 8)
+    """
+    center = (steps_number + 1) / 2 if center is None else center
+    width = steps_number / 10 if width is None else width
+    probabilities = HOM_func(np.arange(1, steps_number + 1), 0.5, visibility, center, width)
+    seeds = np.random.SeedSequence(seed).spawn(steps_number)
+    file_names = []
+    for step, probability in enumerate(probabilities):
+        file_names.append("%s%03d%s" % (file_prefix, step, file_suffix))
+        synthetic_timestamps(file_names[-1], duration, pair_rate=pair_rate, pairs=pairs,
+                             coincidence_probability=probability,
+                             seed=seeds[step], **options)
+    return file_names
@@ -0,0 +1,66 @@
+import os
+import numpy as np
+
+# Binary format of TDC_writeTimestamps(file, 1): 10 bytes per event, the
+# time in units of the TDC bin (about 81 ps for the ID800) followed by the
+# channel, both little endian
+TIMESTAMP_DTYPE = np.dtype([('timestamp', '<i8'), ('channel', '<u2')])
+
+def load_timestamps(file_name, start=0, stop=None):
+    """Maps an ID800 timestamp file in memory, without reading it.
+
+    The file is exposed as a structured array over the file itself: pages
+    are read by the operating system when they are used, so this returns at
+    once whatever the size of the file, and only the parts that are used are
+    ever in memory. A trailing incomplete event, of a file still being
+    written, is left out.
+
+    Args:
+        file_name (str): A file written by :meth:`qlab.controllers.IDQ800.run_acquisition`.
+        start (int, optional): The first event.
+        stop (int, optional): The event after the last one.
+            Default: the end of the file.
+
+    Returns:
+        array: A read-only array of dtype :data:`TIMESTAMP_DTYPE`, with the
+        fields ``timestamp`` and ``channel``.
+
+    Examples:
+        >>> events = load_timestamps('timestamps1.bin')
+        >>> clicks = np.bincount(events['channel'])
+    """
+    events = os.path.getsize(file_name) // TIMESTAMP_DTYPE.itemsize
+    stop = events if stop is None else min(stop, events)
+    start = min(start, stop)
+    if stop == start:
+        return np.empty(0, dtype=TIMESTAMP_DTYPE)
+    return np.memmap(file_name, dtype=TIMESTAMP_DTYPE, mode='r',
+                     offset=start * TIMESTAMP_DTYPE.itemsize, shape=(stop - start,))
+
+def iter_timestamps(file_name, chunk_size=1 << 22, start=0, stop=None):
+    """Iterates over an ID800 timestamp file in chunks of events.
+
+    Chunks are views of a memory map of the file, so nothing is copied and
+    files larger than the memory can be processed one chunk at a time.
+
+    Args:
+        file_name (str): The timestamp file.
+        chunk_size (int, optional): The number of events per chunk.
+            Default: 4M events, 40 MB.
+        start (int, optional): The first event.
+        stop (int, optional): The event after the last one.
+            Default: the end of the file.
+
+    Yields:
+        array: Consecutive chunks of events, see :func:`load_timestamps`.
+
+    Examples:
+        Count the events of each channel of a 50 GB run
+
+        >>> clicks = np.zeros(8, dtype=int)
+        >>> for chunk in iter_timestamps('timestamps1.bin'):
+        ...     clicks += np.bincount(chunk['channel'], minlength=8)
+    """
+    events = load_timestamps(file_name, start, stop)
+    for first in range(0, len(events), chunk_size):
+        yield events[first:first + chunk_size]
@@ -1,10 +1,12 @@
 from setuptools import setup, Extension
 import numpy
+import sys
 
 permanentModule = Extension('qlab.utils.permanent',
                        sources=['qlab/utils/src/qlabmodule.c'],
                        extra_compile_args=["-Ofast", "-march=native"],
-                       include_dirs=[numpy.get_include()])
+                       include_dirs=[numpy.get_include()],
+                       libraries=[] if sys.platform == 'win32' else ['pthread'])
 
 setup(
     name='qlab',